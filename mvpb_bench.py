@@ -0,0 +1,118 @@
+"""
+Benchmark accuracy and speed of MV Polar Bears attendance forecast
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import logging
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+from mvpb_util import LocalWorksheet, read_sheet
+from mvpb_forecast import retrospective, forecast_metrics, RETROSPECTIVE_CHUNK, ENGINES
+
+# constants
+BENCH_OUTPUT = 'forecast_bench.jsonl'
+LATENCY_PERCENTILES = [50, 90, 99]
+
+# init logging
+logger = logging.getLogger('mv-polar-bears')
+
+
+def latency_summary(fit_sec):
+    """
+    Summarize distribution of per-fit wall times
+
+    Arguments:
+        fit_sec: array of per-fit wall times, in seconds
+
+    Returns: dict with mean, max, and percentiles (e.g. p50) in seconds
+    """
+    if not len(fit_sec):
+        return {}
+    summary = {'mean': float(np.mean(fit_sec)), 'max': float(np.max(fit_sec))}
+    for pct in LATENCY_PERCENTILES:
+        summary['p{}'.format(pct)] = float(np.percentile(fit_sec, pct))
+    return summary
+
+
+def benchmark(snapshot, first=400, refit_every=1, n_jobs=1,
+              chunk_size=RETROSPECTIVE_CHUNK, engine='garch'):
+    """
+    Run retrospective forecast on a fixed dataset and measure it
+
+    Arguments:
+        snapshot: path to CSV copy of the sheet, see mvpb_util.LocalWorksheet
+        first, refit_every, n_jobs, chunk_size, engine: see retrospective()
+
+    Returns: dict with settings, accuracy metrics (see forecast_metrics), and
+        timing (total wall time and per-fit latency distribution)
+    """
+    with open(snapshot, 'rb') as fp:
+        snapshot_sha1 = hashlib.sha1(fp.read()).hexdigest()
+    data = read_sheet(LocalWorksheet(snapshot))
+
+    stats = {}
+    tic = perf_counter()
+    mean, std = retrospective(data, first=first, disp=False, refit_every=refit_every,
+                              n_jobs=n_jobs, chunk_size=chunk_size, stats=stats,
+                              engine=engine)
+    wall_sec = perf_counter() - tic
+
+    return {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'snapshot': os.path.basename(snapshot),
+        'snapshot_sha1': snapshot_sha1,
+        'settings': {
+            'engine': engine,
+            'first': first,
+            'refit_every': refit_every,
+            'n_jobs': n_jobs,
+            'chunk_size': chunk_size,
+            },
+        'accuracy': forecast_metrics(data['GROUP'].fillna(0).values, mean, std),
+        'timing': {
+            'wall_sec': wall_sec,
+            'num_fits': len(stats.get('fit_sec', [])),
+            'fit_sec': latency_summary(stats.get('fit_sec', [])),
+            },
+        }
+
+
+# command line interface
+if __name__ == '__main__':
+
+    # arguments
+    ap = argparse.ArgumentParser(
+        description="Benchmark MV Polar Bears attendance forecast",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument('snapshot', help="Path to CSV copy of the data sheet")
+    ap.add_argument('--engine', default='garch', choices=['garch'] + sorted(ENGINES),
+                    help='Forecast engine')
+    ap.add_argument('--first', type=int, default=400,
+                    help='Index of first timestep to forecast')
+    ap.add_argument('--refit_every', type=int, default=1,
+                    help='Number of timesteps between model fits')
+    ap.add_argument('--n_jobs', type=int, default=1,
+                    help='Number of worker processes')
+    ap.add_argument('--chunk_size', type=int, default=RETROSPECTIVE_CHUNK,
+                    help='Number of model fits per chunk')
+    ap.add_argument('--output', default=BENCH_OUTPUT,
+                    help='File to append results to, one JSON object per line')
+    ap.add_argument('--log_level', help='Log level to display',
+                    choices=['critical', 'error', 'warning', 'info', 'debug'],
+                    default='info')
+    args = ap.parse_args()
+
+    lvl = getattr(logging, args.log_level.upper())
+    logging.basicConfig(level=lvl)
+    logger.setLevel(lvl)
+
+    # run
+    result = benchmark(args.snapshot, args.first, args.refit_every, args.n_jobs,
+                       args.chunk_size, args.engine)
+    with open(args.output, 'a') as fp:
+        fp.write(json.dumps(result, sort_keys=True) + '\n')
+    logger.info('Benchmark results: {}'.format(json.dumps(result, indent=2, sort_keys=True)))
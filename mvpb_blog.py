@@ -3,15 +3,17 @@ Build Jekyll post exploring MV Polar Bears dataset
 """
 
 import os
-from mvpb_util import get_client, read_sheet
+from mvpb_util import get_client, read_sheet_incremental, run_stages, Stage
+from mvpb_util import get_table_data, get_template_env, render_templates
+from mvpb_util import frame_digest
 from mvpb_data import get_weather_conditions, get_water_conditions
 from mvpb_forecast import tomorrow as forecast_tomorrow
 from mvpb_forecast import retrospective as forecast_retrospective
+from mvpb_forecast import RETROSPECTIVE_CACHE, TOMORROW_CACHE, forecast_metrics
+from mvpb_plot import attendance_plots, set_font_size, format_legend
 from bokeh import plotting as bk_plt
-from bokeh import models as bk_model
 from bokeh import embed as bk_embed
 from bokeh import layouts as bk_layouts
-import jinja2
 import pytz
 import dateutil
 from numpy import nan
@@ -23,176 +25,46 @@ from datetime import datetime, timedelta
 import json
 import numpy as np
 import pandas as pd
+from functools import partial
 
 # constants
 TEMPLATES_DIR = 'templates'
 WEBPAGE_TITLE = 'MV Polar Bears!'
 PUBLISH_DIR = 'docs'
-GROUP_COLOR = 'royalblue'
-NEWBIES_COLOR = 'forestgreen'
-FONT_SIZE = '12pt'
-DAY_TO_MSEC = 60*60*24*1000
 US_EASTERN = pytz.timezone('US/Eastern')
 PLOT_WIDTH = 750
 PLOT_HEIGHT = 600
+STAGE_CACHE_DIR = os.path.join('data', 'blog_stages') # results of build stages
 
 # init logging
 logger = logging.getLogger('mv-polar-bears')
 
 
-def set_font_size(fig):
-    """Update font sizes in input Bokeh figures"""
-    fig.title.text_font_size = FONT_SIZE
-    fig.xaxis.axis_label_text_font_size = FONT_SIZE
-    fig.yaxis.axis_label_text_font_size = FONT_SIZE
-    fig.xaxis.major_label_text_font_size = FONT_SIZE
-    fig.yaxis.major_label_text_font_size = FONT_SIZE
-    fig.legend.label_text_font_size = FONT_SIZE
-
-
-def set_ylabel_to_positive(fig):
-    """Replace negative-valued y labels with thier absolute value"""
-    fig.yaxis.formatter = bk_model.FuncTickFormatter(code="return Math.abs(tick)")
-
-
-def format_legend(fig):
-    """Simple legend formatting"""
-    fig.legend.location = "top_left"
-
-
-def daily_bar_plot(data, limit=None):
-    """
-    Arguments:
-        data: pandas dataframe
-        limit: int, max number of results to include, set None to include all
-
-    Returns: script, div
-        script: javascript function controlling plot, wrapped in <script> HTML tags
-        div: HTML <div> modified by javascript to show plot
-    """
-    logger.info('Generating daily bar plot')
-
-    # truncate data, if requested
-    if not limit:
-        limit = 0
-    time = data.index[-limit:]
-    grp = data['GROUP'][-limit:]
-    newb = data['NEWBIES'][-limit:]
-
-    # create figure
-    fig = bk_plt.figure(
-        title="Daily Attendence",
-        x_axis_label='Date',
-        x_axis_type='datetime',
-        y_axis_label='# Attendees',
-        plot_width=PLOT_WIDTH,
-        plot_height=PLOT_HEIGHT,
-        tools="pan,wheel_zoom,box_zoom,reset",
-        logo=None
-        )
-    
-    # add bar plots
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=0, top=grp,
-        color=GROUP_COLOR, legend='Group')
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=-newb, top=0,
-        color=NEWBIES_COLOR, legend='Newbies')
-
-    # additional formatting
-    set_font_size(fig)
-    set_ylabel_to_positive(fig)
-    format_legend(fig)
+def get_weather_forecast(data, darksky_keyfile):
+    """Return weather conditions forecast for the day after the last row"""
+    tomorrow = data.index[-1] + timedelta(days=1)
+    with open(os.path.expanduser(darksky_keyfile), 'r') as fp:
+        darksky_key = json.load(fp)['secret_key']
+    return get_weather_conditions(darksky_key, dt=tomorrow)
 
-    return bk_embed.components(fig)
 
+def get_water_forecast(data):
+    """Return water conditions for the day after the last row"""
+    # latest observation is the best available
+    tomorrow = data.index[-1] + timedelta(days=1)
+    return get_water_conditions(tomorrow, None, max_gap_sec=None)
 
-def cumul_bears_plot(data):
-    """
-    Arguments:
-        data: pandas dataframe
 
-    Returns: script, div
-        script: javascript function controlling plot, wrapped in <script> HTML tags
-        div: HTML <div> modified by javascript to show plot
+def get_forecast_data(group, weather, water):
     """
-    logger.info('Generating cumulative bears plot')
-
-    # create figure
-    fig = bk_plt.figure(
-        title='Cumulative Number of Polar Bears',
-        x_axis_label='Date',
-        x_axis_type='datetime',
-        y_axis_label='# Polar Bears',
-        plot_width=PLOT_WIDTH,
-        plot_height=PLOT_HEIGHT,
-        tools="pan,wheel_zoom,box_zoom,reset",
-        logo=None
-        )
-
-    # prep data
-    time = data.index.values
-    grp = data['GROUP'].fillna(0).cumsum()
-    newb = data['NEWBIES'].fillna(0).cumsum()
-    
-    # plot bars
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=0, top=grp,
-        color=GROUP_COLOR, legend='Group')
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=-newb, top=0,
-        color=NEWBIES_COLOR, legend='Newbies')
-
-    # additional formatting
-    set_font_size(fig)
-    set_ylabel_to_positive(fig)
-    format_legend(fig)
-
-    return bk_embed.components(fig)
-
+    Return forecast for attendence, weather, and water conditions
 
-def get_table_data(data):
-    """
-    Munge data to build a daily view of all available data
-    
     Arguments:
-        data: pandas dataframe
-
-    Returns:
-        list of dicts, each containing data for a single day, with no gaps
+        group: tuple, attendance forecast mean and std, see forecast_tomorrow()
+        weather: dict, as returned by get_weather_forecast()
+        water: dict, as returned by get_water_forecast()
     """
-    logger.info('Generating summary table')
-
-    table_dict = data.T.to_dict()
-    table = []
-    for date in sorted(data.index):
-        table.append(table_dict[date])
-    table.sort(key=lambda x: x['DATE'], reverse=True)
-    for ii in range(len(table)):
-        for k, v in table[ii].items():
-            if pd.isnull(v):
-                table[ii][k] = None
-    return table
-
-
-def get_forecast_data(data, darksky_keyfile):
-    """
-    Return forecast for attendence, weather, and water conditions
-    """
-    # init time for next day
-    tomorrow = data.index[-1] + timedelta(days=1)
-
-    # get weather for tomorrow
-    with open(os.path.expanduser(darksky_keyfile), 'r') as fp:
-        darksky_key = json.load(fp)['secret_key']
-    weather = get_weather_conditions(darksky_key, dt=tomorrow)
-
-    # get water for tomorrow
-    water = get_water_conditions(tomorrow, None)
-
-    # get attendance for tomorrow
-    grp_mean, grp_std = forecast_tomorrow(data)
-
+    grp_mean, grp_std = group
     forecast = {
         'GROUP': grp_mean,
         'GROUP_STD': grp_std,
@@ -206,6 +78,11 @@ def get_forecast_data(data, darksky_keyfile):
 def forecast_plot(time, obs, pred_mean, pred_std):
     """
     Plot retrospective forecast mean, variance, and residuals
+
+    Arguments:
+        time, obs: numpy arrays, observation times and values
+        pred_mean, pred_std: numpy arrays, forecasts for the same times as
+            obs, pred_mean is modified in place
     """
     upper_bound = pred_mean + pred_std
     lower_bound = pred_mean - pred_std
@@ -275,6 +152,25 @@ def forecast_plot(time, obs, pred_mean, pred_std):
     return bk_embed.components(bk_layouts.column(fig_a, fig_b))
 
 
+def retrospective_plot(data, retrospective):
+    """
+    Log metrics for and plot retrospective forecast
+
+    Arguments:
+        data: pandas dataframe
+        retrospective: tuple, forecast mean and std, see forecast_retrospective()
+
+    Returns: script, div, as forecast_plot()
+    """
+    time = data.index.values
+    obs = data['GROUP'].fillna(0).values
+    mean, std = retrospective
+    logger.info('Retrospective forecast metrics: {}'.format(
+                forecast_metrics(obs, mean, std)))
+    # forecast made at time[t] is for the next session, time[t+1]
+    return forecast_plot(time[1:], obs[1:], mean[:-1].copy(), std[:-1])
+
+
 def scatter_plot(data, xname, yname):
     """
     Generate simple scatter plot for pair of variables
@@ -357,15 +253,52 @@ def all_scatter_plots(data):
     return scripts, divs
 
 
-def update(google_keyfile, darksky_keyfile, log_level):
+def get_stages(data, darksky_keyfile):
+    """
+    Return build stages for the blog post, see mvpb_util.run_stages()
+
+    Stages run on threads. The retrospective forecast (the slowest stage)
+    owns a pool of worker processes, started from its thread.
+    """
+    return {
+        'table': Stage(lambda: list(get_table_data(data)), [], 'thread'),
+        'attendance': Stage(partial(
+            attendance_plots, data, PLOT_WIDTH, PLOT_HEIGHT, group_label='Group',
+            cumul_title='Cumulative Number of Polar Bears',
+            cumul_y_label='# Polar Bears', daily_days=None), [], 'thread'),
+        'scatter': Stage(partial(all_scatter_plots, data), [], 'thread'),
+        'weather': Stage(partial(get_weather_forecast, data, darksky_keyfile), [], 'thread'),
+        'water': Stage(partial(get_water_forecast, data), [], 'thread'),
+        'tomorrow': Stage(partial(forecast_tomorrow, data, cache=TOMORROW_CACHE), [], 'thread'),
+        'forecast': Stage(get_forecast_data, ['tomorrow', 'weather', 'water'], 'thread'),
+        'retrospective': Stage(partial(
+            forecast_retrospective, data, first=400, cache=RETROSPECTIVE_CACHE,
+            n_jobs=os.cpu_count() or 1), [], 'thread'),
+        'retrospective_plot': Stage(partial(retrospective_plot, data),
+                                    ['retrospective'], 'thread'),
+        }
+
+
+def update(google_keyfile, darksky_keyfile, log_level, local_sheet=None,
+           full_resync=False, stages=None):
     """
     Get data and build static HTML / JS site
+
+    Independent build stages run concurrently (see get_stages()), and the
+    result of each is cached, so that individual stages can be rebuilt.
     
     Arguments:
         google_keyfile: Google Sheets API key
         darksky_keyfile: DarkSky API key
         log_level: string, logging level, one of 'critical', 'error',
             'warning', 'info', 'debug'
+        local_sheet: path to CSV file to read in place of the Google sheet,
+            or None to use the Google sheet
+        full_resync: bool, set True to read the full sheet rather than only
+            rows changed since the last run
+        stages: list of stage names to rebuild, along with the stages that
+            depend on them, using cached results for the rest if the sheet
+            is unchanged, or None to rebuild all
     """
     lvl = getattr(logging, log_level.upper())
     logging.basicConfig(level=lvl)
@@ -373,38 +306,31 @@ def update(google_keyfile, darksky_keyfile, log_level):
 
     logger.info('Updating MV Polar Bears website')
 
-    client, doc, sheet = get_client(google_keyfile)
-    data = read_sheet(sheet) 
+    client, doc, sheet = get_client(google_keyfile, local_sheet)
+    data = read_sheet_incremental(sheet, full=full_resync)
     
-    daily_table = get_table_data(data)
-    daily_bar_script, daily_bar_div = daily_bar_plot(data)
-    cumul_script, cumul_div = cumul_bears_plot(data)
-    forecast_data = get_forecast_data(data, darksky_keyfile)
-    scatter_scripts, scatter_divs = all_scatter_plots(data)
-
-    time = data.index.values
-    obs = data['GROUP'].fillna(0).values
-    mean, std = forecast_retrospective(data, first=400)
-    forecast_script, forecast_div = forecast_plot(time, obs, mean, std)
-
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+    results = run_stages(get_stages(data, darksky_keyfile),
+                         cache_dir=STAGE_CACHE_DIR, only=stages,
+                         key=frame_digest(data))
+    daily_table = results['table']
+    attendance_script, (daily_bar_div, cumul_div) = results['attendance']
+    forecast_data = results['forecast']
+    scatter_scripts, scatter_divs = results['scatter']
+    forecast_script, forecast_div = results['retrospective_plot']
+
+    render_templates(
+        get_template_env(TEMPLATES_DIR),
+        {'blog.md': os.path.join(PUBLISH_DIR, 'blog.md')},
+        title=WEBPAGE_TITLE,
+        daily_table=daily_table,
+        daily_bar_div=daily_bar_div, cumul_div=cumul_div,
+        attendance_script=attendance_script,
+        last_update=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        scatter_divs=scatter_divs, scatter_scripts=scatter_scripts,
+        forecast=forecast_data,
+        forecast_div=forecast_div, forecast_script=forecast_script,
         )
 
-    blog_template = env.get_template('blog.md')
-    with open(os.path.join(PUBLISH_DIR, 'blog.md'), 'w') as blog_fp:
-        blog_content = blog_template.render(
-            title=WEBPAGE_TITLE,
-            daily_table=daily_table,
-            daily_bar_div=daily_bar_div, daily_bar_script=daily_bar_script,
-            cumul_div=cumul_div, cumul_script=cumul_script,
-            last_update=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            scatter_divs=scatter_divs, scatter_scripts=scatter_scripts,
-            forecast=forecast_data,
-            forecast_div=forecast_div, forecast_script=forecast_script,
-            )
-        blog_fp.write(blog_content)
-
     logger.info('Update complete')
 
 
@@ -420,7 +346,17 @@ if __name__ == '__main__':
     ap.add_argument('--log_level', help='Log level to display',
                     choices=['critical', 'error', 'warning', 'info', 'debug'],
                     default='info')
+    ap.add_argument('--local_sheet', default=None,
+                    help='Path to CSV file to read instead of the Google '
+                         'sheet, google_key is ignored if set')
+    ap.add_argument('--full_resync', action='store_true',
+                    help='Read the full sheet, not just rows changed since '
+                         'the last run')
+    ap.add_argument('--stage', action='append', dest='stages', default=None,
+                    help='Rebuild only this stage (and stages that depend '
+                         'on it), may be repeated')
     args = ap.parse_args()
 
     # run
-    update(args.google_key, args.darksky_key, args.log_level) 
+    update(args.google_key, args.darksky_key, args.log_level, args.local_sheet,
+           args.full_resync, args.stages) 
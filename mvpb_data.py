@@ -14,26 +14,63 @@ import math
 import dateutil
 from pdb import set_trace
 import logging
-from time import sleep
+from time import sleep, monotonic
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import io
-import re
-import pickle
+import glob
+import hashlib
+import sqlite3
 import numpy as np
 import argparse
 from pkg_resources import resource_filename
-from mvpb_util import get_client, read_sheet
+from mvpb_util import get_client, http_get_cached
+from mvpb_util import _trim_values, _values_to_frame, _set_datetime_index
 
 # constants
 BUOY_NUM = '44020' # Buoy in Nantucket Sound
 DATA_DIR = 'data'
-# TODO: don't bother with the pickle file
-BUOY_HISTORICAL = os.path.join(DATA_DIR, 'historical.pkl')
+BUOY_SOURCES = os.path.join(DATA_DIR, '*.txt')
+BUOY_ARCHIVE_DIR = os.path.join(DATA_DIR, 'archive')
+BUOY_ARCHIVE_MANIFEST = os.path.join(BUOY_ARCHIVE_DIR, 'manifest.json')
+BUOY_ARCHIVE_VERSION = 2 # bump to invalidate all archived years
+BUOY_ARCHIVE_DECIMALS = 2 # NDBC stdmet precision, undoes float32 rounding
+NDBC_MISSING = {  # NDBC field -> missing-value sentinel
+    'WDIR': 999, 'WSPD': 99, 'GST': 99, 'WVHT': 99, 'DPD': 99, 'APD': 99,
+    'MWD': 999, 'PRES': 9999, 'ATMP': 999, 'WTMP': 999, 'DEWP': 999,
+    'VIS': 99, 'PTDY': 99, 'TIDE': 99}
+BUOY_MAX_GAP_SEC = 2*60*60 # max time to nearest water conditions record
+HTTP_CACHE_DIR = os.path.join(DATA_DIR, 'http_cache') # NDBC realtime feeds
+HTTP_CACHE_TTL_SEC = 30*60 # NDBC realtime feeds update hourly
+HTTP_CACHE_MAX_BYTES = 50*1024*1024
+HTTP_CACHE_OFFLINE = False # set True to use pre-seeded cache only
+WEATHER_CACHE = os.path.join(DATA_DIR, 'weather.sqlite') # set None to disable
+WEATHER_CACHE_DECIMALS = 3 # coordinate rounding for cache keys, ~100 m
+WEATHER_MAX_WORKERS = 4 # concurrent DarkSky requests
+WEATHER_RATE_PER_SEC = 5 # sustained DarkSky request rate
 LOG_LEVEL = logging.INFO
 GOOGLE_WAIT_SEC = 60
 INKWELL_LAT = 41.452463 # degrees N
 INKWELL_LON = -70.553526 # degrees E
 US_EASTERN = pytz.timezone('US/Eastern')
 UTC = pytz.timezone('UTC')
+SESSION_TIME = pd.Timedelta(hours=7, minutes=30) # local time for new rows
+
+WATER_FIELDS = {  # NBDC names -> local names
+    'WVHT': 'WAVE-HEIGHT-METERS',
+    'DPD': 'DOMINANT-WAVE-PERIOD-SECONDS',
+    'APD': 'AVERAGE-WAVE-PERIOD-SECONDS',
+    'MWD': 'DOMINANT-WAVE-DIRECTION-DEGREES-CW-FROM-N',
+    'WTMP': 'WATER-TEMPERATURE-DEGREES-C',
+    }
+
+# nearest-observation index over water conditions records
+WaterIndex = namedtuple('WaterIndex', ['epochs', 'data'])
+
+# weather cache hit/miss counters, for this process
+weather_cache_stats = {'hits': 0, 'misses': 0}
+weather_cache_stats_lock = threading.Lock() # workers update stats concurrently
 
 # init logging
 logger = logging.getLogger('mv-polar-bears')
@@ -119,144 +156,312 @@ def get_column_indices(sheet, base=0):
     return {name: ii+base for ii, name in enumerate(hdr)}
 
 
-@api
-def add_missing_days(sheet):
+def read_snapshot(sheet):
     """
-    Add (empty) rows in sheet for missing days
-    
+    Read sheet once for use by all update stages, in a single request
+
     Arguments:
         sheet: gspread sheet, connected
+
+    Returns: header, content
+        header: list of column names, in sheet order
+        content: dataframe, as returned by read_sheet()
     """
-    logger.info('Adding rows for missing days')
+    values = _trim_values(sheet.get_all_values())
+    content = _set_datetime_index(_values_to_frame(values))
+    return values[0], content
 
-    # get current content
-    content = read_sheet(sheet)
-    col2ind = get_column_indices(sheet, base=0)
-
-    def new_row(dt):
-        """Return list of cells for a new row at datetime 'dt'"""
-        row = [None] * len(content.columns)
-        row[col2ind['DATE']] = dt.strftime('%Y-%m-%d')
-        row[col2ind['TIME']] = dt.strftime('%H:%M %p')
-        return row
-
-    # ensure minimum daily frequency by adding empty rows as needed
-    rid = 3 # 1-based index to google sheet row
-    prev_dt = content.iloc[1].name
-    for ii in range(1, len(content)): # index to local copy
-        row = content.iloc[ii]
-
-        # delete empty rows, they are sometime created by API errors
-        if all(pd.isnull(row)):
-            sheet.delete_row(rid)
-            logger.warning('Deleted empty row, index {}'.format(rid))
-            continue
 
-        # check for gap and fill it
-        curr_dt = row.name
-        missing_days = (curr_dt - prev_dt).days - 1
-        for jj in range(missing_days):
-            day = prev_dt + timedelta(days=jj + 1)
-            sheet.insert_row(new_row(day), rid, 'USER_ENTERED')
-            logger.info('Added row for {} at index {}'.format(day, rid))
-            rid += 1
-        
-        # proceed to next row
-        prev_dt = curr_dt
-        rid += 1
+def _sheet_value(val):
+    """Convert local value to a value that can be written to the sheet"""
+    if pd.isnull(val):
+        return ''
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
 
-    # add rows up to current day if needed
-    latest = curr_dt
-    today = datetime.now(tz=US_EASTERN).replace(hour=7, minute=30, second=0, microsecond=0)
-    while curr_dt < today:
-        curr_dt += timedelta(days=1)
-        sheet.append_row(new_row(curr_dt), 'USER_ENTERED')
-        logger.info('Appended row for {}'.format(curr_dt))
 
+def write_snapshot(sheet, header, original, content):
+    """
+    Write changes in local content back to sheet in a single batch request
 
-@api
-def add_missing_dows(sheet):
+    Cells that differ from the original are written, unchanged cells inside
+    the updated range are sent as null, which the Sheets API skips. If rows
+    were added or removed, every row from the first changed row down is
+    rewritten, and rows beyond the new end are cleared.
+
+    Arguments:
+        sheet: gspread sheet, connected
+        header: list of column names, in sheet order
+        original: dataframe, sheet content as read
+        content: dataframe, updated sheet content
+    """
+    old = original[header].values
+    new = content[header].values
+
+    # first row whose position in the sheet changed, if any
+    num_same = min(len(old), len(new))
+    same_date = original['DATE'].values[:num_same] == content['DATE'].values[:num_same]
+    shifted = np.flatnonzero(~same_date)
+    first_shifted = shifted[0] if len(shifted) else num_same
+    num_rows = max(len(old), len(new))
+
+    # compile dense rectangle of cell values, None where unchanged
+    values = np.full((num_rows, len(header)), None, dtype=object)
+    stable = slice(0, first_shifted)
+    changed = (old[stable] != new[stable]) & ~(pd.isnull(old[stable]) & pd.isnull(new[stable]))
+    for ii, jj in zip(*np.nonzero(changed)):
+        values[ii, jj] = _sheet_value(new[ii, jj])
+    for ii in range(first_shifted, num_rows):
+        for jj in range(len(header)):
+            values[ii, jj] = _sheet_value(new[ii, jj]) if ii < len(new) else ''
+
+    rows = np.flatnonzero(pd.notnull(values).any(axis=1))
+    if not len(rows):
+        logger.info('No changes to write')
+        return
+    cols = np.flatnonzero(pd.notnull(values).any(axis=0))
+    r0, r1, c0, c1 = rows[0], rows[-1], cols[0], cols[-1]
+
+    # grow sheet if needed, index in sheet is 1-based with header
+    if r1 + 2 > sheet.row_count:
+        sheet.add_rows(r1 + 2 - sheet.row_count)
+
+    cells = []
+    for ii in range(r0, r1 + 1):
+        for jj in range(c0, c1 + 1):
+            cells.append(gspread.models.Cell(ii + 2, jj + 1, values[ii, jj]))
+    sheet.update_cells(cells, 'USER_ENTERED')
+    logger.info('Wrote {} changed cells in rows {}-{}'.format(
+                sum(c.value is not None for c in cells), r0 + 2, r1 + 2))
+
+
+def fill_missing_days(content):
+    """
+    Add (empty) rows for missing days, and drop empty rows
+
+    Gaps are found by comparing the (local) dates in the sheet against a
+    daily date range up to today, new rows are stamped at SESSION_TIME.
+
+    Arguments:
+        content: dataframe, as returned by read_sheet()
+
+    Returns: dataframe, with one row per day up to today
+    """
+    logger.info('Adding rows for missing days')
+
+    # drop empty rows, they are sometime created by API errors
+    empty = content.isnull().all(axis=1).values
+    for ii in np.flatnonzero(empty):
+        logger.warning('Dropped empty row, index {}'.format(ii + 2))
+    content = content[~empty]
+
+    # find missing days, using local dates to avoid DST artifacts
+    dates = content.index.tz_localize(None).normalize()
+    today = datetime.now(tz=US_EASTERN).replace(tzinfo=None)
+    days = pd.date_range(dates.min(), today, freq='D').normalize()
+    missing = days.difference(dates)
+    if not len(missing):
+        return content
+
+    # add empty rows and restore chronological order
+    missing_dts = (missing + SESSION_TIME).tz_localize(US_EASTERN)
+    new = pd.DataFrame(nan, index=missing_dts, columns=content.columns)
+    new['DATE'] = missing_dts.strftime('%Y-%m-%d')
+    new['TIME'] = missing_dts.strftime('%H:%M %p')
+    for day in missing:
+        logger.info('Added row for {}'.format(day.date()))
+    return pd.concat([content, new]).sort_index(kind='mergesort')
+
+
+def fill_missing_dows(content):
     """
     Populate missing day-of-week cells
 
     Arguments:
-        sheet: gspread sheet, connected
+        content: dataframe, as returned by read_sheet()
+
+    Returns: dataframe, updated copy of content
     """
     logger.info('Adding missing day-of-week data')
 
-    # get current content
-    content = read_sheet(sheet)
+    content = content.copy()
+    content['DAY-OF-WEEK'] = content['DAY-OF-WEEK'].astype(object)
+    missing = content['DAY-OF-WEEK'].isnull().values
+    content.loc[missing, 'DAY-OF-WEEK'] = content.index[missing].strftime('%A')
+    logger.info('Added day-of-week for {} rows'.format(missing.sum()))
+    return content
 
-    # find col to update
-    sheet_col_idx = get_column_indices(sheet, base=1)['DAY-OF-WEEK']
 
-    # compile list of cells to update at-once
-    to_update = []
-    for ii in range(len(content)):
-        row = content.iloc[ii]
-        if pd.isnull(row['DAY-OF-WEEK']):
-            dt = row.name
-            dow = dt.strftime('%A')
-            sheet_row_idx = ii + 2 # index in sheet, 1-based with header
-            cell = gspread.models.Cell(sheet_row_idx, sheet_col_idx, dow)
-            to_update.append(cell)
-            logger.info('Queue add day-of-week {} -> {}'.format(dt, dow))
+def token_bucket(rate, burst=1):
+    """
+    Return a blocking rate limiter implemented as a token bucket
 
-    # update all at once
-    if to_update:
-        sheet.update_cells(to_update, 'USER_ENTERED')
-        logger.info('Updated day-of-week for {} rows'.format(len(to_update)))
+    Arguments:
+        rate: float, sustained calls per second
+        burst: int, max calls allowed back-to-back
 
+    Returns: callable, blocks until a call is allowed, safe to use from
+        multiple threads
+    """
+    lock = threading.Lock()
+    state = {'tokens': burst, 'time': monotonic()}
 
-@api
-def add_missing_weather(sheet, darksky_key):
+    def acquire():
+        while True:
+            with lock:
+                now = monotonic()
+                tokens = min(burst, state['tokens'] + (now - state['time'])*rate)
+                state['time'] = now
+                if tokens >= 1:
+                    state['tokens'] = tokens - 1
+                    return
+                state['tokens'] = tokens
+                delay = (1 - tokens)/rate
+            sleep(delay)
+
+    return acquire
+
+
+def fill_missing_weather(content, darksky_key, max_workers=WEATHER_MAX_WORKERS,
+                         rate_per_sec=WEATHER_RATE_PER_SEC):
     """
     Populate missing weather cells
 
+    Weather for missing rows is fetched concurrently. If the DarkSky quota is
+    exceeded, fetching stops and the rows retrieved so far are kept.
+
     Arguments:
-        sheet: gspread sheet, connected
+        content: dataframe, as returned by read_sheet()
         darksky_key: path to DarkSky API key file
+        max_workers: int, max concurrent DarkSky requests
+        rate_per_sec: float, max sustained DarkSky request rate
+
+    Returns: dataframe, updated copy of content
     """
     logger.info('Adding missing weather conditions data')
 
     # constants
-    batch_size = 25 
     weather_col_names = [
         'CLOUD-COVER-PERCENT', 'HUMIDITY-PERCENT', 'PRECIP-RATE-INCHES-PER-HOUR',
         'PRECIP-PROBABILITY', 'WEATHER-SUMMARY', 'AIR-TEMPERATURE-DEGREES-F',
         'WIND-BEARING-CW-DEGREES-FROM-N', 'WIND-GUST-SPEED-MPH',
         'WIND-SPEED-MPH']     
-    col_idxs = get_column_indices(sheet, base=1)
     with open(darksky_key, 'r') as fp:
         key = json.load(fp)['secret_key']
 
-    # get current content
-    content = read_sheet(sheet)
-
-    # compile list of cells to update at-once
-    to_update = []
-    for ii in range(len(content)):
-        row = content.iloc[ii]
-        if all(pd.isnull(row[weather_col_names])):
-            # get weather
-            dt = row.name
-            weather_data = get_weather_conditions(key, dt=dt)
-            # queue update for all missing cells
-            sheet_row_idx = ii + 2 # index in sheet, 1-based with header
-            for col_name in weather_col_names:
-                sheet_col_idx = col_idxs[col_name]
-                new_value = weather_data[col_name]
-                cell = gspread.models.Cell(sheet_row_idx, sheet_col_idx, new_value)
-                to_update.append(cell)
-                logger.info('Queue {} -> {} for row {}'.format(col_name, new_value, sheet_row_idx))
-
-        # update batch
-        batch_full = len(to_update) >= batch_size 
-        last_batch = (ii == len(content)-1) and to_update
-        if batch_full or last_batch:
-            sheet.update_cells(to_update, 'USER_ENTERED')
-            logger.info('Updated weather conditions data in {} cells'.format(len(to_update)))
-            to_update = []
+    content = content.copy()
+    content[weather_col_names] = content[weather_col_names].astype(object)
+    col_locs = [content.columns.get_loc(c) for c in weather_col_names]
+    missing = np.flatnonzero(content[weather_col_names].isnull().all(axis=1).values)
+
+    # fetch concurrently, keeping a bounded window of requests in flight
+    throttle = token_bucket(rate_per_sec, burst=max_workers)
+    rows = iter(missing)
+    pending = deque()
+    num_added = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+        def submit_next():
+            for ii in rows:
+                dt = content.index[ii]
+                pending.append((ii, pool.submit(
+                    get_weather_conditions, key, dt=dt, throttle=throttle)))
+                return
+
+        for _ in range(2*max_workers):
+            submit_next()
+
+        while pending:
+            ii, future = pending.popleft()
+            try:
+                weather_data = future.result()
+            except Exception as err:
+                # stop cleanly, drop requests not yet started
+                for _, other in pending:
+                    other.cancel()
+                if is_darksky_quota_error(err):
+                    logger.error('DarkSky API quota exceeded, keeping {} rows'.format(num_added))
+                    break
+                raise
+            submit_next()
+
+            for col_name, col_loc in zip(weather_col_names, col_locs):
+                content.iat[ii, col_loc] = weather_data[col_name]
+            num_added += 1
+            logger.info('Added weather conditions for {}'.format(content.index[ii]))
+
+    logger.info('Weather cache hits: {hits}, misses: {misses}'.format(**weather_cache_stats))
+    return content
+
+
+def fill_missing_water(content):
+    """
+    Populate missing water conditions cells
+
+    Arguments:
+        content: dataframe, as returned by read_sheet()
+
+    Returns: dataframe, updated copy of content
+    """
+    logger.info('Adding missing water conditions data')
+
+    # constants
+    water_col_names = list(WATER_FIELDS.values())
+
+    # get water conditions for all missing rows at once
+    content = content.copy()
+    missing = np.flatnonzero(content[water_col_names].isnull().all(axis=1).values)
+    if not len(missing):
+        return content
+    water_data = get_water_conditions_batch(content.index[missing])
+    for col_name in water_col_names:
+        col_loc = content.columns.get_loc(col_name)
+        for jj, ii in enumerate(missing):
+            content.iat[ii, col_loc] = _water_convert_type(water_data[col_name].iloc[jj])
+    logger.info('Added water conditions for {} rows'.format(len(missing)))
+    return content
+
+
+@api
+def add_missing_days(sheet):
+    """
+    Add (empty) rows in sheet for missing days
+    
+    Arguments:
+        sheet: gspread sheet, connected
+    """
+    header, content = read_snapshot(sheet)
+    write_snapshot(sheet, header, content, fill_missing_days(content))
+
+
+@api
+def add_missing_dows(sheet):
+    """
+    Populate missing day-of-week cells
+
+    Arguments:
+        sheet: gspread sheet, connected
+    """
+    header, content = read_snapshot(sheet)
+    write_snapshot(sheet, header, content, fill_missing_dows(content))
+
+
+@api
+def add_missing_weather(sheet, darksky_key, max_workers=WEATHER_MAX_WORKERS,
+                        rate_per_sec=WEATHER_RATE_PER_SEC):
+    """
+    Populate missing weather cells
+
+    Arguments:
+        sheet: gspread sheet, connected
+        darksky_key: path to DarkSky API key file
+        max_workers: int, max concurrent DarkSky requests
+        rate_per_sec: float, max sustained DarkSky request rate
+    """
+    header, content = read_snapshot(sheet)
+    filled = fill_missing_weather(content, darksky_key, max_workers, rate_per_sec)
+    write_snapshot(sheet, header, content, filled)
 
 
 @api
@@ -266,52 +471,79 @@ def add_missing_water(sheet):
 
     Arguments:
         sheet: gspread sheet, connected
+    """
+    header, content = read_snapshot(sheet)
+    write_snapshot(sheet, header, content, fill_missing_water(content))
+
 
+@api
+def update_sheet(sheet, darksky_key, weather_workers=WEATHER_MAX_WORKERS,
+                 weather_rate=WEATHER_RATE_PER_SEC):
     """
-    logger.info('Adding missing water conditions data')
+    Apply all update stages to a single snapshot of the sheet
 
-    # constants
-    batch_size = 50 
-    water_col_names = [
-        'WAVE-HEIGHT-METERS',
-        'DOMINANT-WAVE-PERIOD-SECONDS',
-        'AVERAGE-WAVE-PERIOD-SECONDS',
-        'DOMINANT-WAVE-DIRECTION-DEGREES-CW-FROM-N',
-        'WATER-TEMPERATURE-DEGREES-C']
-        
-    col_idxs = get_column_indices(sheet, base=1)
-
-    # get current content
-    content = read_sheet(sheet)
-
-    # compile list of cells to update at-once
-    historical = get_historical_water_conditions()
-    to_update = []
-    for ii in range(len(content)):
-        row = content.iloc[ii]
-        if all(pd.isnull(row[water_col_names])):
-            # get water conditions 
-            dt = row.name
-            water_data = get_water_conditions(dt, historical)
-            # queue update for all missing cells
-            sheet_row_idx = ii + 2 # index in sheet, 1-based with header
-            for col_name in water_col_names:
-                sheet_col_idx = col_idxs[col_name]
-                new_value = water_data[col_name]
-                cell = gspread.models.Cell(sheet_row_idx, sheet_col_idx, new_value)
-                to_update.append(cell)
-                logger.info('Queue {} -> {} for row {}'.format(col_name, new_value, sheet_row_idx))
-
-        # update batch
-        batch_full = len(to_update) >= batch_size 
-        last_batch = (ii == len(content)-1) and to_update
-        if batch_full or last_batch:
-            sheet.update_cells(to_update, 'USER_ENTERED')
-            logger.info('Updated water conditions data in {} cells'.format(len(to_update)))
-            to_update = []
-
-
-def get_weather_conditions(key, lon=INKWELL_LON, lat=INKWELL_LAT, dt=None):
+    The sheet is read once, all stages are applied locally, and changed cells
+    are written back in a single batch request.
+
+    Arguments:
+        sheet: gspread sheet, connected
+        darksky_key: path to DarkSky API key file
+        weather_workers: int, max concurrent DarkSky requests
+        weather_rate: float, max sustained DarkSky request rate
+    """
+    header, original = read_snapshot(sheet)
+    content = fill_missing_days(original)
+    content = fill_missing_dows(content)
+    content = fill_missing_weather(content, darksky_key, weather_workers, weather_rate)
+    content = fill_missing_water(content)
+    write_snapshot(sheet, header, original, content)
+
+
+def _weather_cache_key(lon, lat, dt):
+    """Return weather cache key (lat, lon, hour) for a location and time"""
+    hour = math.floor(dt.timestamp() / 3600) * 3600
+    return (round(lat, WEATHER_CACHE_DECIMALS), round(lon, WEATHER_CACHE_DECIMALS), hour)
+
+
+def _weather_cache_connect():
+    """Return connection to the weather cache database, created if needed"""
+    conn = sqlite3.connect(WEATHER_CACHE, timeout=30)
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS weather ('
+        'lat REAL, lon REAL, hour INTEGER, payload TEXT, '
+        'PRIMARY KEY (lat, lon, hour))')
+    return conn
+
+
+def _weather_cache_get(cache_key):
+    """Return cached raw weather payload for 'cache_key', or None"""
+    conn = _weather_cache_connect()
+    try:
+        row = conn.execute(
+            'SELECT payload FROM weather WHERE lat=? AND lon=? AND hour=?',
+            cache_key).fetchone()
+    finally:
+        conn.close()
+    with weather_cache_stats_lock:
+        weather_cache_stats['misses' if row is None else 'hits'] += 1
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def _weather_cache_put(cache_key, payload):
+    """Store raw weather payload for 'cache_key'"""
+    conn = _weather_cache_connect()
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO weather VALUES (?, ?, ?, ?)',
+                         cache_key + (json.dumps(payload),))
+    finally:
+        conn.close()
+
+
+def get_weather_conditions(key, lon=INKWELL_LON, lat=INKWELL_LAT, dt=None,
+                           throttle=None):
     """
     Retrieve forecast or observed weather conditions
     
@@ -326,6 +558,12 @@ def get_weather_conditions(key, lon=INKWELL_LON, lat=INKWELL_LAT, dt=None):
             negative is south, default is Inkwell beach, Oak Bluffs
         dt: datetime, timezone-aware, time for observation, default is now in
             US/Eastern timezone
+        throttle: callable or None, called before each API request (not
+            before cache hits), e.g. a rate limiter from token_bucket()
+
+    Raw payloads for past times (observations) are cached in the SQLite
+    database WEATHER_CACHE, keyed on rounded coordinates and the hour, and
+    read from there first. Forecasts are always requested.
     
     Returns: Dict with the following fields (renamed from forecast.io):
         CLOUD-COVER-PERCENT: The percentage of sky occluded by clouds, between
@@ -350,14 +588,23 @@ def get_weather_conditions(key, lon=INKWELL_LON, lat=INKWELL_LAT, dt=None):
     if not dt:
         dt = datetime.now(tz=US_EASTERN)
 
-    # request data from Dark Sky API (e.g. forecast.io)
-    stamp = math.floor(dt.timestamp())
-    url = 'https://api.darksky.net/forecast/{}/{:.10f},{:.10f},{}'.format(
-        key, lat, lon, stamp)
-    params = {'units': 'us'}
-    resp = requests.get(url, params)
-    resp.raise_for_status()
-    data = resp.json()
+    # read from cache, if available
+    cache_key = _weather_cache_key(lon, lat, dt)
+    data = _weather_cache_get(cache_key) if WEATHER_CACHE else None
+
+    if data is None:
+        # request data from Dark Sky API (e.g. forecast.io)
+        stamp = math.floor(dt.timestamp())
+        url = 'https://api.darksky.net/forecast/{}/{:.10f},{:.10f},{}'.format(
+            key, lat, lon, stamp)
+        params = {'units': 'us'}
+        if throttle:
+            throttle()
+        resp = requests.get(url, params)
+        resp.raise_for_status()
+        data = resp.json()
+        if WEATHER_CACHE and dt < datetime.now(tz=UTC):
+            _weather_cache_put(cache_key, data)
     
     # reformat resulting data
     fields = {  # forecast.io names -> local names
@@ -374,77 +621,295 @@ def get_weather_conditions(key, lon=INKWELL_LON, lat=INKWELL_LAT, dt=None):
     return {v: data['currently'].get(n, None) for n, v in fields.items()}
 
 
-def _water_to_datetime(row):
-    dt = datetime(
-        year=round(row['YY']), month=round(row['MM']), day=round(row['DD']),
-        hour=round(row['hh']), minute=round(row['mm']), tzinfo=UTC)
-    return dt
+def _water_to_dataframe(txt):
+    """
+    Parse NDBC standard meteorological text data to a dataframe
+
+    Fields are whitespace-delimited, with a two-line header (names, units)
+    prefixed by '#'. Missing-value sentinels (see NDBC_MISSING) are mapped to
+    NaN, and the DATETIME column is built from the YY/MM/DD/hh/mm columns.
 
+    Arguments:
+        txt: string, raw text as downloaded from NDBC
 
-def _water_to_dataframe(txt):
-    stream = io.StringIO(re.sub(r' +', ' ', txt).replace('#', ''))
-    data = pd.read_csv(stream, sep=' ', skiprows=[1])
-    data.replace('MM', nan)
+    Returns: dataframe, one column per NDBC field, plus DATETIME (UTC)
+    """
+    names = txt.split('\n', 1)[0].lstrip('#').split()
+    na_values = {n: ['MM', v] for n, v in NDBC_MISSING.items() if n in names}
+    data = pd.read_csv(io.StringIO(txt), sep=r'\s+', header=None, names=names,
+                       comment='#', na_values=na_values)
+    parts = data[['YY', 'MM', 'DD', 'hh', 'mm']]
+    parts.columns = ['year', 'month', 'day', 'hour', 'minute']
+    data['DATETIME'] = pd.to_datetime(parts).dt.tz_localize(UTC)
     return data
 
 
 def _water_convert_type(val):
-    if isinstance(val, np.float64):
+    if pd.isnull(val):
+        return None
+    elif isinstance(val, np.float64):
         return float(val)
     elif isinstance(val, np.int64):
         return float(val)
     elif isinstance(val, str):
-        if val == 'MM':
-            return None 
         return float(val)
     else:
         # default case, do nothing 
         return val
 
 
-def get_historical_water_conditions():
+def _water_source_digest(src):
+    """Return SHA-1 hex digest of the raw source file 'src'"""
+    sha = hashlib.sha1()
+    with open(src, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _water_to_archive(data):
+    """
+    Convert parsed NDBC dataframe to a typed record array for the archive
+
+    Arguments:
+        data: dataframe, as returned by _water_to_dataframe()
+
+    Returns: numpy structured array with int64 EPOCH (seconds, UTC) and one
+        float32 field per measurement column
     """
-    Retrieve historical water conditions data and cache as pickle
+    skip = ('YY', 'MM', 'DD', 'hh', 'mm', 'DATETIME')
+    cols = [c for c in data.columns if c not in skip]
+    rec = np.empty(len(data), dtype=[('EPOCH', np.int64)] + [(c, np.float32) for c in cols])
+    dts = pd.to_datetime(data['DATETIME'], utc=True)
+    rec['EPOCH'] = dts.values.astype('datetime64[s]').astype(np.int64)
+    for col in cols:
+        rec[col] = pd.to_numeric(data[col], errors='coerce').values
+    return rec
+
+
+def _water_from_archive(rec):
+    """
+    Convert archive record array back to a dataframe
+
+    Arguments:
+        rec: numpy structured array, as returned by _water_to_archive()
 
     Returns: dataframe, see get_water_conditions for column definitions
     """
+    cols = [c for c in rec.dtype.names if c != 'EPOCH']
+    data = pd.DataFrame(
+        {c: rec[c].astype(np.float64).round(BUOY_ARCHIVE_DECIMALS) for c in cols},
+        columns=cols)
+    data['DATETIME'] = pd.to_datetime(rec['EPOCH'], unit='s', utc=True)
+    return data
 
-    if os.path.isfile(BUOY_HISTORICAL):
-        # read cached pickle
-        with open(BUOY_HISTORICAL, 'rb') as fp:
-            water_historical_data = pickle.load(fp)
-    else:
-        # parse raw sources
-        sources = [
-            os.path.join(DATA_DIR, '2014.txt'), 
-            os.path.join(DATA_DIR, '2015.txt'),
-            os.path.join(DATA_DIR, '2016.txt'),
-            os.path.join(DATA_DIR, '2017.txt'),
-            os.path.join(DATA_DIR, '2018-01.txt'),
-            os.path.join(DATA_DIR, '2018-02.txt'),
-            os.path.join(DATA_DIR, '2018-03.txt'),
-            ]
-        dfs = []
-        for src in sources:
-            with open(src, 'r') as fp:
-                src_txt = fp.read()
-            dfs.append(_water_to_dataframe(src_txt))
-        water_historical_data = dfs[0].append(dfs[1:])
-        water_historical_data.reset_index(drop=True, inplace=True)
-        water_historical_data['DATETIME'] = water_historical_data.apply(_water_to_datetime, axis=1)
-        # cache as pickle
-        with open(BUOY_HISTORICAL, 'wb') as fp:
-            pickle.dump(water_historical_data, fp)
 
+def _read_water_manifest():
+    """Return archive manifest, or an empty one if missing or out of date"""
+    try:
+        with open(BUOY_ARCHIVE_MANIFEST, 'r') as fp:
+            manifest = json.load(fp)
+    except (IOError, ValueError):
+        manifest = {}
+    if manifest.get('version') != BUOY_ARCHIVE_VERSION:
+        manifest = {'version': BUOY_ARCHIVE_VERSION, 'sources': {}}
+    return manifest
+
+
+def _write_water_manifest(manifest):
+    """Write archive manifest atomically"""
+    tmp = BUOY_ARCHIVE_MANIFEST + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(tmp, BUOY_ARCHIVE_MANIFEST)
+
+
+def _archive_water_source(src, arc):
+    """
+    Parse raw NDBC source file and write it to the archive
+
+    Arguments:
+        src: path to raw NDBC stdmet text file
+        arc: path to archive .npy file to write
+
+    Returns: record array written to the archive
+    """
+    logger.info('Archiving water conditions source {}'.format(src))
+    with open(src, 'r') as fp:
+        data = _water_to_dataframe(fp.read())
+    rec = _water_to_archive(data)
+    tmp = arc + '.tmp'
+    with open(tmp, 'wb') as fp:
+        np.save(fp, rec)
+    os.replace(tmp, arc)
+    return rec
+
+
+def get_historical_water_conditions():
+    """
+    Retrieve historical water conditions data from the local archive
+
+    Each raw source file in DATA_DIR is parsed once and stored as a typed
+    numpy record array in BUOY_ARCHIVE_DIR. A manifest records the mtime and
+    SHA-1 of each source, so only new or modified sources are re-parsed.
+
+    Returns: dataframe, see get_water_conditions for column definitions
+    """
+    if not os.path.isdir(BUOY_ARCHIVE_DIR):
+        os.makedirs(BUOY_ARCHIVE_DIR)
+    manifest = _read_water_manifest()
+
+    sources = {}
+    recs = []
+    for src in sorted(glob.glob(BUOY_SOURCES)):
+        name = os.path.basename(src)
+        arc = os.path.join(BUOY_ARCHIVE_DIR, os.path.splitext(name)[0] + '.npy')
+        mtime = os.path.getmtime(src)
+        entry = manifest['sources'].get(name)
+
+        # check mtime first, fall back to content hash if it changed
+        current = entry is not None and os.path.isfile(arc)
+        if current and entry['mtime'] != mtime:
+            digest = _water_source_digest(src)
+            current = digest == entry['sha1']
+            entry = {'mtime': mtime, 'sha1': digest}
+
+        if current:
+            recs.append(np.load(arc, mmap_mode='r'))
+        else:
+            recs.append(_archive_water_source(src, arc))
+            entry = {'mtime': mtime, 'sha1': _water_source_digest(src)}
+        sources[name] = entry
+
+    if sources != manifest['sources']:
+        manifest['sources'] = sources
+        _write_water_manifest(manifest)
+
+    water_historical_data = pd.concat(
+        [_water_from_archive(rec) for rec in recs], ignore_index=True)
     return water_historical_data
 
 
-def get_water_conditions(dt, historical):
+def _to_epochs(dts):
+    """Return int64 epoch seconds (UTC) for a sequence of datetimes"""
+    dts = pd.to_datetime(pd.Series(list(dts), dtype=object), utc=True)
+    return dts.values.astype('datetime64[s]').astype(np.int64)
+
+
+def get_water_index(data):
+    """
+    Build nearest-observation index over water conditions records
+
+    Arguments:
+        data: dataframe containing water conditions data, as returned by
+            _water_to_dataframe() or get_historical_water_conditions()
+
+    Returns: WaterIndex, with records sorted by time and their int64 epoch
+        seconds (UTC), for use with lookup_water_index()
+    """
+    data = data[data['DATETIME'].notnull()]
+    epochs = data['DATETIME'].values.astype('datetime64[s]').astype(np.int64)
+    order = np.argsort(epochs, kind='mergesort')
+    return WaterIndex(epochs[order], data.iloc[order].reset_index(drop=True))
+
+
+def lookup_water_index(index, dts, max_gap_sec=BUOY_MAX_GAP_SEC):
+    """
+    Return the nearest water conditions record for each of a batch of times
+
+    Arguments:
+        index: WaterIndex, as returned by get_water_index()
+        dts: sequence of timezone-aware datetimes, query times
+        max_gap_sec: int or None, maximum time between query and record, set
+            None to always accept the nearest record
+
+    Returns: dataframe with one row per query time, in input order, rows with
+        no record within max_gap_sec are all-NaN
+    """
+    query = _to_epochs(dts)
+    num = len(index.epochs)
+    if num == 0:
+        out = index.data.reindex(range(len(query)))
+        return out
+
+    # nearest of the records bracketing each query time
+    right = np.searchsorted(index.epochs, query)
+    left = np.clip(right - 1, 0, num - 1)
+    right = np.clip(right, 0, num - 1)
+    use_left = np.abs(query - index.epochs[left]) <= np.abs(index.epochs[right] - query)
+    nearest = np.where(use_left, left, right)
+
+    out = index.data.iloc[nearest].reset_index(drop=True)
+    if max_gap_sec is not None:
+        too_far = np.abs(index.epochs[nearest] - query) > max_gap_sec
+        out.loc[too_far, :] = nan
+    return out
+
+
+def _get_recent_water(url):
+    """Download (or read cached) and parse recent water conditions data from NDBC 'url'"""
+    logger.info('Retrieving water conditions data from {}'.format(url))
+    txt = http_get_cached(url, HTTP_CACHE_DIR, HTTP_CACHE_TTL_SEC,
+                          max_bytes=HTTP_CACHE_MAX_BYTES, offline=HTTP_CACHE_OFFLINE)
+    return _water_to_dataframe(txt)
+
+
+def get_water_conditions_batch(dts, historical=None, max_gap_sec=BUOY_MAX_GAP_SEC):
+    """
+    Retrieve observed water conditions at many times in a single pass
+
+    Query times are grouped by source (NDBC 5-day, 45-day, and historical
+    data, see get_water_conditions), and each source is downloaded or loaded
+    at most once.
+
+    Arguments:
+        dts: sequence of timezone-aware datetimes, observation times
+        historical: dataframe or WaterIndex, as in get_water_conditions(),
+            set None to load from the local archive only if needed
+        max_gap_sec: int or None, maximum time between each query time and
+            its nearest record, set None to always accept the nearest record
+
+    Returns: dataframe with one row per query time, in input order, with
+        columns named as in the dict returned by get_water_conditions(), and
+        NaN where no record is available
+    """
+    query = _to_epochs(dts)
+    now = _to_epochs([datetime.now(tz=UTC)])[0]
+    delta_days = (now - query) // (24*60*60)
+
+    sources = [
+        (delta_days <= 5,
+         'http://www.ndbc.noaa.gov/data/5day2/{}_5day.txt'.format(BUOY_NUM)),
+        ((delta_days > 5) & (delta_days <= 45),
+         'http://www.ndbc.noaa.gov/data/realtime2/{}.txt'.format(BUOY_NUM)),
+        (delta_days > 45, None),
+        ]
+
+    out = pd.DataFrame(nan, index=range(len(query)), columns=list(WATER_FIELDS.values()))
+    dts = pd.Series(list(dts), dtype=object)
+    for in_source, url in sources:
+        if not in_source.any():
+            continue
+        if url:
+            index = get_water_index(_get_recent_water(url))
+        else:
+            if historical is None:
+                historical = get_historical_water_conditions()
+            if not isinstance(historical, WaterIndex):
+                historical = get_water_index(historical)
+            index = historical
+        recs = lookup_water_index(index, dts[in_source], max_gap_sec)
+        out.loc[in_source, list(WATER_FIELDS.values())] = recs[list(WATER_FIELDS)].values
+
+    return out
+
+
+def get_water_conditions(dt, historical, max_gap_sec=BUOY_MAX_GAP_SEC):
     """
     Retrieve observed water conditions at specified time
     
-    Loads data from local pickle file, if available, else downloads from NOAA
-    parses to a dataframe, and pickles it.
+    Uses the local historical archive for old observations, else downloads
+    recent data from NOAA and parses it to a dataframe.
     
     Data come from the nearest NOAA station as historical and realtime (last
     45 days) datasets, formatted as tabular text files, see:
@@ -453,9 +918,13 @@ def get_water_conditions(dt, historical):
     Arguments:
         dt: datetime, timezone aware, observation time
         historical: dataframe containing historical water conditions data, as
-            returned by get_historical_water_conditions(), included as an
-            argument to avoid re-reading data from disk if this function is
-            called multiple times
+            returned by get_historical_water_conditions(), or WaterIndex built
+            from it by get_water_index(), included as an argument to avoid
+            re-reading and re-indexing data if this function is called
+            multiple times
+        max_gap_sec: int or None, maximum time between dt and the nearest
+            record, fields are None if no record is this close, set None to
+            always accept the nearest record
     
     Returns: dict with the following fields:
         WAVE-HEIGHT-METERS: Significant wave height (meters) is calculated as
@@ -477,63 +946,17 @@ def get_water_conditions(dt, historical):
             platforms it varies with tide, but is referenced to, or near Mean
             Lower Low Water (MLLW).
     """
-    # init times
-    dt_utc = dt.astimezone(UTC)
-    now_utc = datetime.now(tz=UTC)
-    delta_days = (now_utc - dt_utc).days
-
-    if delta_days <= 5:
-        # retrieve hourly data for past 5 days
-        url = 'http://www.ndbc.noaa.gov/data/5day2/{}_5day.txt'.format(BUOY_NUM)
-        resp = requests.get(url)
-        resp.raise_for_status()
-        data = _water_to_dataframe(resp.text)
-        data['DATETIME'] = data.apply(_water_to_datetime, axis=1)
-    
-    elif delta_days <= 45:
-        # retrieve hourly data for past 45 days
-        url = 'http://www.ndbc.noaa.gov/data/realtime2/{}.txt'.format(BUOY_NUM)
-        resp = requests.get(url)
-        resp.raise_for_status()
-        data = _water_to_dataframe(resp.text)
-        data['DATETIME'] = data.apply(_water_to_datetime, axis=1)
-
-    else:
-        data = historical
-
-    # find the nearest record, should be within 2 hours
-    time_diff = abs(dt_utc - data['DATETIME'])
-    idx = time_diff.idxmin()
-    rec = data.iloc[idx]
-    logger.info('Closest water conditions record to {} is {}'.format(
-                dt_utc, data.iloc[idx]['DATETIME']))
-
-    # reformat resulting data
-    fields = {  # NBDC names -> local names
-        'WVHT': 'WAVE-HEIGHT-METERS',
-        'DPD': 'DOMINANT-WAVE-PERIOD-SECONDS',
-        'APD': 'AVERAGE-WAVE-PERIOD-SECONDS',
-        'MWD': 'DOMINANT-WAVE-DIRECTION-DEGREES-CW-FROM-N',
-        'WTMP': 'WATER-TEMPERATURE-DEGREES-C',
-        }
-    out = {v: _water_convert_type(rec[n]) for n, v in fields.items()}
-
-    # set NA values
-    na_values = {
-        'WAVE-HEIGHT-METERS': 99,
-        'DOMINANT-WAVE-PERIOD-SECONDS': 99,
-        'AVERAGE-WAVE-PERIOD-SECONDS': 99,
-        'DOMINANT-WAVE-DIRECTION-DEGREES-CW-FROM-N': 999,
-        'WATER-TEMPERATURE-DEGREES-C': 99,
-        }
-    for key, val in na_values.items():
-        if out[key] == val:
-            out[key] = None 
-
+    rec = get_water_conditions_batch([dt], historical, max_gap_sec).iloc[0]
+    out = {k: _water_convert_type(v) for k, v in rec.items()}
+    if all(v is None for v in out.values()):
+        logger.warning('No water conditions record within {}s of {}'.format(
+                       max_gap_sec, dt))
     return out
 
 
-def update(google_key, darksky_key, log_level):
+def update(google_key, darksky_key, log_level,
+           weather_workers=WEATHER_MAX_WORKERS, weather_rate=WEATHER_RATE_PER_SEC,
+           local_sheet=None):
     """
     Update all data in MV Polar Bears data sheet
     
@@ -542,17 +965,18 @@ def update(google_key, darksky_key, log_level):
         darksky_key: path to DarkSky API key file
         log_level: string, logging level, one of 'critical', 'error',
             'warning', 'info', 'debug'
+        weather_workers: int, max concurrent DarkSky requests
+        weather_rate: float, max sustained DarkSky request rate
+        local_sheet: path to CSV file to use in place of the Google sheet, or
+            None to use the Google sheet
     """
     lvl = getattr(logging, log_level.upper())
     logging.basicConfig(level=lvl)
     logger.setLevel(lvl)
 
     logger.info('Updating MV Polar Bears data sheet')
-    client, doc, sheet = get_client(google_key) 
-    add_missing_days(sheet)
-    add_missing_dows(sheet)
-    add_missing_weather(sheet, darksky_key)
-    add_missing_water(sheet)
+    client, doc, sheet = get_client(google_key, local_sheet) 
+    update_sheet(sheet, darksky_key, weather_workers, weather_rate)
     logger.info('Update complete')
 
 
@@ -568,8 +992,16 @@ if __name__ == '__main__':
     ap.add_argument('--log_level', help='Log level to display',
                     choices=['critical', 'error', 'warning', 'info', 'debug'],
                     default='info')
+    ap.add_argument('--weather_workers', type=int, default=WEATHER_MAX_WORKERS,
+                    help='Max concurrent DarkSky requests')
+    ap.add_argument('--weather_rate', type=float, default=WEATHER_RATE_PER_SEC,
+                    help='Max sustained DarkSky requests per second')
+    ap.add_argument('--local_sheet', default=None,
+                    help='Path to CSV file to update instead of the Google '
+                         'sheet, google_key is ignored if set')
     args = ap.parse_args()
 
     # run 
-    update(args.google_key, args.darksky_key, args.log_level) 
+    update(args.google_key, args.darksky_key, args.log_level,
+           args.weather_workers, args.weather_rate, args.local_sheet) 
 
@@ -6,80 +6,780 @@ from mvpb_util import read_sheet
 import pandas as pd
 import numpy as np
 from arch import arch_model
+from scipy.signal import lfilter
+from scipy.stats import norm
 import logging
+import os
+import json
+import hashlib
+from time import perf_counter
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# constants
+MODEL_LAGS = [1, 3, 5] # autoregressive lags
+MODEL_EXOG = [ # sheet columns used as regressors, after day-of-week
+    'AIR-TEMPERATURE-DEGREES-F', 'WIND-SPEED-MPH', 'PRECIP-PROBABILITY',
+    'WAVE-HEIGHT-METERS', 'WATER-TEMPERATURE-DEGREES-C']
+MODEL_SPEC = ( # recorded with cached results
+    "arch_model(y, x, mean='ARX', lags=[1,3,5]), "
+    "x: day-of-week one-hots (Tue-Sun), weather/water (ffill, then 0), "
+    "forecasts hold weather/water at origin values")
+RETROSPECTIVE_CACHE = os.path.join('data', 'retrospective.npz')
+RETROSPECTIVE_CHUNK = 50 # fits per chunk, warm-starts reset at chunk boundaries
+TOMORROW_CACHE = os.path.join('data', 'tomorrow.json')
+TOMORROW_UPDATE_MAXITER = 25 # optimizer iterations when updating cached fit
+TOMORROW_ENGINE_LAG = 7 # rows before the end at which engine state is cached
+FORECAST_HORIZON = 7 # days ahead in forecast table
+FORECAST_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95] # reported in forecast table
 
 
 # init logging
 logger = logging.getLogger('mv-polar-bears')
 
 
-def get_model(data):
+# model inputs, see features()
+Features = namedtuple('Features', ['y', 'x', 'dow', 'names'])
+
+
+def _dow_columns(dow):
+    """Return day-of-week one-hot columns (Monday is the baseline)"""
+    return (np.asarray(dow)[:, None] == np.arange(1, 7)).astype(np.float64)
+
+
+def features(data):
+    """
+    Return model inputs built once from the sheet, for reuse by all fits
+
+    Exogenous regressors are day-of-week one-hots and the weather/water
+    columns in MODEL_EXOG. Missing values are filled with the previous day's
+    value, or zero before the first value, so each row uses only data known
+    on that day. Lagged attendance is not included, the models build it
+    from y.
+
+    Arguments:
+        data: pandas Dataframe read from sheet
+
+    Returns: Features namedtuple with fields
+        y: float64 array of observations
+        x: dense float64 array of exogenous regressors, one row per day
+        dow: int array of day of week, 0 is Monday
+        names: list of column names for x
+    """
+    y = data['GROUP'].fillna(0).values.astype(np.float64)
+    dow = np.asarray(data.index.dayofweek)
+    exog = data[MODEL_EXOG].apply(pd.to_numeric, errors='coerce')
+    exog = exog.ffill().fillna(0).values
+    x = np.ascontiguousarray(np.hstack((_dow_columns(dow), exog)), dtype=np.float64)
+    names = ['DOW-{}'.format(d) for d in range(1, 7)] + MODEL_EXOG
+    return Features(y, x, dow, names)
+
+
+def _future_exog(x, dow, origins, horizon):
+    """
+    Return exogenous regressors for the days after each forecast origin
+
+    Day-of-week columns follow the calendar, weather/water columns hold their
+    values at the origin, so backtests see only what was known at the time,
+    as forecasts past the last row of the sheet do.
+
+    Arguments:
+        x, dow: as in features()
+        origins: array of int, forecast origins
+        horizon: int, number of steps
+
+    Returns: array shaped (num_origins, horizon, num_exog)
+    """
+    origins = np.asarray(origins)
+    fut = np.repeat(x[origins, None, :], horizon, axis=1)
+    days = (dow[origins, None] + np.arange(1, horizon + 1)) % 7
+    fut[:, :, :6] = _dow_columns(days.ravel()).reshape(len(origins), horizon, 6)
+    return fut
+
+
+def _get_model(y, x):
+    """Return GARCH model object for observations 'y', see get_model()"""
+    return arch_model(y, x=x, mean='ARX', lags=MODEL_LAGS)
+
+
+def get_model(data, feats=None):
     """
     Return GARCH model object including data and settings
     
     Arguments:
         data: pandas Dataframe read from sheet
+        feats: Features for data, as returned by features(), or None to build
     """
-    mod = arch_model(data['GROUP'].fillna(0).values, mean='ARX', lags=[1,3,5])
-    return mod
+    if feats is None:
+        feats = features(data)
+    return _get_model(feats.y, feats.x)
 
 
-# TODO: include some performance metric
-def retrospective(data, first=500,  disp=100):
+def _garch_forecast(params, y, x, last_obs, origins, x_future):
+    """
+    Return multi-step forecasts of the ARX-GARCH(1,1) model, see _get_model()
+
+    Uses the same recursions as the arch forecast() method, which only
+    accepts future exogenous regressors in releases newer than the pinned
+    version. Forecasts from an origin use data up to the origin only.
+
+    Arguments:
+        params: array of fitted parameters, in arch order: constant, lags,
+            exogenous, omega, alpha, beta
+        y, x: model inputs, as returned by features()
+        last_obs: int, end of the sample used in the fit, which initializes
+            the variance recursion
+        origins: array of int, consecutive forecast origins
+        x_future: array of future regressors, see _future_exog()
+
+    Returns: mean, variance, arrays shaped (num_origins, horizon), variance
+        includes propagation of shocks through the lags
+    """
+    num_lags = max(MODEL_LAGS)
+    num_mean = 1 + len(MODEL_LAGS) + x.shape[1]
+    const = params[0]
+    ar = np.zeros(num_lags)
+    ar[np.array(MODEL_LAGS) - 1] = params[1:1+len(MODEL_LAGS)]
+    beta_x = params[1+len(MODEL_LAGS):num_mean]
+    omega, alpha, beta = params[num_mean:num_mean+3]
+    origins = np.asarray(origins)
+    horizon = x_future.shape[1]
+
+    # residuals and conditional variance after the lag hold-back, the
+    # recursion starts from a weighted mean of early squared residuals
+    lagged = np.column_stack([y[num_lags-lag:len(y)-lag] for lag in range(1, num_lags + 1)])
+    resid = y[num_lags:] - const - lagged @ ar - x[num_lags:] @ beta_x
+    tau = min(75, last_obs - num_lags)
+    weights = 0.94 ** np.arange(tau)
+    backcast = weights @ resid[:tau]**2 / weights.sum()
+    drive = omega + alpha * np.concatenate(([backcast], resid[:-1]**2))
+    sigma2, _ = lfilter([1.0], [1.0, -beta], drive, zi=[beta * backcast])
+
+    # variance of residuals, then of the forecast, through the AR impulse response
+    idx = origins - num_lags
+    res_var = np.empty((len(origins), horizon))
+    res_var[:, 0] = omega + alpha * resid[idx]**2 + beta * sigma2[idx]
+    for hh in range(1, horizon):
+        res_var[:, hh] = omega + (alpha + beta) * res_var[:, hh-1]
+    impulse = np.zeros(horizon)
+    impulse[0] = 1.0
+    for hh in range(1, horizon):
+        kk = min(num_lags, hh)
+        impulse[hh] = impulse[hh-kk:hh][::-1] @ ar[:kk]
+    variance = np.empty_like(res_var)
+    for hh in range(horizon):
+        variance[:, hh] = res_var[:, :hh+1] @ impulse[hh::-1]**2
+
+    # mean, substituting forecasts for observations past the origin
+    path = np.column_stack([y[origins - lag] for lag in range(num_lags - 1, -1, -1)])
+    path = np.hstack((path, np.zeros((len(origins), horizon))))
+    for hh in range(horizon):
+        path[:, num_lags+hh] = (const + path[:, hh:num_lags+hh] @ ar[::-1]
+                                + x_future[:, hh] @ beta_x)
+    return path[:, num_lags:], variance
+
+
+class SeasonalEngine(object):
+    """
+    Day-of-week baseline forecast engine
+
+    The forecast for a day is the exponentially-weighted mean and standard
+    deviation of past observations on the same day of the week. Each update
+    is O(1).
+    """
+
+    def __init__(self, num_exog, alpha=0.1):
+        self.alpha = alpha
+        self.mean = np.full(7, np.nan)
+        self.var = np.zeros(7)
+
+    def predict(self, hist, x, dow):
+        """Return mean, std forecast for a day, see RLSEngine.predict()"""
+        mean = self.mean[dow]
+        if np.isnan(mean):
+            mean = np.nanmean(self.mean) if not np.isnan(self.mean).all() else 0.0
+        return mean, np.sqrt(self.var[dow])
+
+    def get_state(self):
+        """Return engine state, see RLSEngine.get_state()"""
+        return {'mean': self.mean.copy(), 'var': self.var.copy()}
+
+    def set_state(self, state):
+        """Restore engine state, see RLSEngine.set_state()"""
+        self.mean = np.array(state['mean'], dtype=np.float64)
+        self.var = np.array(state['var'], dtype=np.float64)
+
+    def update(self, hist, x, dow, y):
+        """Update with observation for a day, see RLSEngine.update()"""
+        if np.isnan(self.mean[dow]):
+            self.mean[dow] = y
+            return
+        err = y - self.mean[dow]
+        self.mean[dow] += self.alpha * err
+        self.var[dow] = (1 - self.alpha) * (self.var[dow] + self.alpha * err**2)
+
+
+class RLSEngine(object):
+    """
+    Recursive-least-squares autoregressive forecast engine
+
+    Linear model of attendance on a constant, lagged attendance (MODEL_LAGS)
+    and same-day exogenous regressors (see features()), with coefficients
+    updated by recursive least squares with exponential forgetting. The
+    forecast standard deviation is the exponentially-weighted RMS of past
+    1-step errors. Each update is O(1) in the length of the history.
+    """
+
+    def __init__(self, num_exog, forget=0.995, delta=100.0, alpha=0.05):
+        num = 1 + len(MODEL_LAGS) + num_exog
+        self.forget = forget
+        self.alpha = alpha
+        self.theta = np.zeros(num)
+        self.P = delta * np.eye(num)
+        self.var = 0.0
+
+    def _regressors(self, hist, x):
+        lagged = [hist[-lag] if len(hist) >= lag else 0.0 for lag in MODEL_LAGS]
+        return np.concatenate(([1.0], lagged, x))
+
+    def predict(self, hist, x, dow):
+        """
+        Return forecast for the next day
+
+        Arguments:
+            hist: array of observations up to, not including, the day
+            x: array of exogenous regressors for the day
+            dow: int, day of week for the day, 0 is Monday
+
+        Returns: mean, std
+        """
+        return self._regressors(hist, x) @ self.theta, np.sqrt(self.var)
+
+    def get_state(self):
+        """Return engine state, a dict of arrays, to persist with results"""
+        return {'theta': self.theta.copy(), 'P': self.P.copy(),
+                'var': np.array(self.var)}
+
+    def set_state(self, state):
+        """Restore engine state returned by get_state()"""
+        self.theta = np.array(state['theta'], dtype=np.float64)
+        self.P = np.array(state['P'], dtype=np.float64)
+        self.var = float(state['var'])
+
+    def update(self, hist, x, dow, y):
+        """
+        Update engine with the observation for the next day
+
+        Arguments:
+            hist, x, dow: as in predict()
+            y: float, observation for the day
+        """
+        phi = self._regressors(hist, x)
+        err = y - phi @ self.theta
+        P_phi = self.P @ phi
+        gain = P_phi / (self.forget + phi @ P_phi)
+        self.theta += gain * err
+        self.P = (self.P - np.outer(gain, P_phi)) / self.forget
+        self.var = (1 - self.alpha) * self.var + self.alpha * err**2
+
+
+ENGINES = {
+    'rls': RLSEngine,
+    'seasonal': SeasonalEngine,
+    }
+
+
+def _engine_spec(engine):
+    """Return description of a recursive engine, recorded with cached results"""
+    return '{} engine; {}'.format(engine, MODEL_SPEC)
+
+
+def _engine_path(eng, buf, num_hist, x, dow, horizon):
+    """
+    Return multi-step forecast from a recursive forecast engine
+
+    Each step uses the forecast mean in place of the observation for the
+    previous step, so a single pass gives all horizons. Engines report the
+    1-step error standard deviation, which is used for all horizons.
+
+    Arguments:
+        eng: forecast engine instance
+        buf: array of observations, with at least num_hist + horizon elements,
+            elements after num_hist are used as scratch space and restored
+        num_hist: int, number of observations up to and including the origin
+        x: 2D array of exogenous regressors, one row per step
+        dow: int, day of week of the origin
+        horizon: int, number of steps
+
+    Returns: mean, std, arrays of length horizon
+    """
+    mean = np.zeros(horizon)
+    std = np.zeros(horizon)
+    saved = buf[num_hist:num_hist+horizon].copy()
+    for hh in range(horizon):
+        mean[hh], std[hh] = eng.predict(buf[:num_hist+hh], x[hh], (dow + hh + 1) % 7)
+        buf[num_hist+hh] = mean[hh]
+    buf[num_hist:num_hist+horizon] = saved
+    return mean, std
+
+
+def _engine_retrospective(engine, feats, first, horizon=1, cache=None):
+    """
+    Return retrospective forecast using a recursive forecast engine
+
+    If a cache file is given, results are persisted there together with the
+    engine state at the last origin whose forecasts use only observed
+    regressors. When the inputs up to and including that origin are
+    unchanged, the engine resumes from the saved state instead of replaying
+    the full history.
+
+    Arguments:
+        engine: string, key in ENGINES
+        feats: Features, as returned by features()
+        first: int, index of first timestep to forecast
+        horizon: int, number of steps to forecast from each origin
+        cache: path to .npz file to persist results, or None
+
+    Returns: mean, std, fit_sec
+        mean, std: 2D arrays, one column per horizon, see retrospective()
+        fit_sec: list of float, wall time of the forecast and update at each
+            origin computed, from first
+    """
+    y, x, dow = feats.y, feats.x, feats.dow
+    spec = _engine_spec(engine)
+    buf = np.concatenate((y, np.zeros(horizon)))
+    num_data = len(y)
+    mean = np.full((num_data, horizon), np.nan)
+    std = np.full((num_data, horizon), np.nan)
+    fit_sec = []
+    eng = ENGINES[engine](x.shape[1])
+
+    # resume from the persisted engine state, if still valid
+    start = 0
+    num_valid, old_mean, old_std, _, state = _load_retrospective(
+        cache, y, x, first, 1, horizon, spec)
+    # the state includes the update with the origin row, so it must be unchanged
+    if state and num_valid > int(state['origin']):
+        start = int(state.pop('origin'))
+        eng.set_state(state)
+        mean[:start] = old_mean[:start]
+        std[:start] = old_std[:start]
+        logger.info('Resuming {} engine at timestep {}'.format(engine, start))
+
+    x_future = _future_exog(x, dow, np.arange(max(start, first), num_data), horizon)
+    checkpoint = max(num_data - 1, start)
+    for ii in range(start, num_data):
+        if ii == checkpoint:
+            state = eng.get_state()
+            state['origin'] = ii
+        # forecast from origin ii, then learn from the next day
+        tic = perf_counter()
+        if ii >= first:
+            mean[ii], std[ii] = _engine_path(
+                eng, buf, ii+1, x_future[ii-max(start, first)], dow[ii], horizon)
+        if ii + 1 < num_data:
+            eng.update(y[:ii+1], x[ii+1], dow[ii+1], y[ii+1])
+        if ii >= first:
+            fit_sec.append(perf_counter() - tic)
+
+    if cache and num_data > start:
+        _save_retrospective(cache, y, x, first, 1, horizon, mean, std,
+                            np.zeros(0), spec, state)
+    return mean, std, fit_sec
+
+
+def _engine_ahead(engine, feats, horizon, cache=None):
+    """
+    Return forecast past the last row of the sheet using a recursive engine
+
+    If a cache file is given, the engine state is stored there a few rows
+    (TOMORROW_ENGINE_LAG) before the end, keyed on a fingerprint of the data
+    up to that row, so that later calls resume from it when rows are
+    appended or the most recent rows are filled in, rather than replaying
+    the full history.
+
+    Arguments:
+        engine: string, key in ENGINES
+        feats: Features, as returned by features()
+        horizon: int, number of steps
+        cache: path to JSON file to cache engine state, or None
+
+    Returns: mean, std, arrays of length horizon
+    """
+    y, x, dow = feats.y, feats.x, feats.dow
+    spec = _engine_spec(engine)
+    eng = ENGINES[engine](x.shape[1])
+
+    # resume from the cached state, if the rows it has seen are unchanged
+    start = 1
+    saved = None
+    if cache and os.path.isfile(cache):
+        with open(cache, 'r') as fp:
+            saved = json.load(fp)
+    if (saved and 'state' in saved and saved['num_obs'] <= len(y)
+            and saved['fingerprint'] == _fingerprint(
+                y[:saved['num_obs']], x[:saved['num_obs']], spec)):
+        eng.set_state(saved['state'])
+        start = saved['num_obs']
+
+    # update with the remaining rows, saving the state at the checkpoint
+    checkpoint = max(len(y) - TOMORROW_ENGINE_LAG, start)
+    for ii in range(start, len(y)):
+        if ii == checkpoint and cache and ii > start:
+            state = {k: np.asarray(v).tolist() for k, v in eng.get_state().items()}
+            with open(cache + '.tmp', 'w') as fp:
+                json.dump({'fingerprint': _fingerprint(y[:ii], x[:ii], spec),
+                           'num_obs': ii, 'state': state}, fp)
+            os.replace(cache + '.tmp', cache)
+        eng.update(y[:ii], x[ii], dow[ii], y[ii])
+
+    x_future = _future_exog(x, dow, [len(y) - 1], horizon)[0]
+    buf = np.concatenate((y, np.zeros(horizon)))
+    return _engine_path(eng, buf, len(y), x_future, dow[-1], horizon)
+
+
+def _load_retrospective(cache, y, x, first, refit_every, horizon,
+                        spec=MODEL_SPEC):
+    """
+    Return results persisted by retrospective() that are valid for 'y', 'x'
+
+    Arguments:
+        cache: path to .npz file written by _save_retrospective()
+        y, x: observations and exogenous regressors, as used by the model
+        first, refit_every, horizon: retrospective() arguments
+        spec: string, model description, results for other models are ignored
+
+    Returns: num_valid, mean, std, params, state
+        num_valid: int, number of leading timesteps with valid results
+        mean, std: 2D arrays of cached results, at least num_valid rows
+        params: array, parameters from the last persisted fit, used only as
+            starting values
+        state: dict of arrays, recursive engine state, empty if none
+    """
+    if not cache or not os.path.isfile(cache):
+        return 0, None, None, None, {}
+    with np.load(cache) as npz:
+        saved = {k: npz[k] for k in npz.files}
+    if (str(saved['spec']) != spec or int(saved['first']) != first
+            or int(saved['refit_every']) != refit_every
+            or int(saved.get('horizon', 0)) != horizon):
+        return 0, None, None, None, {}
+
+    # forecasts use data up to their origin only, so results are valid up to
+    # the first changed observation or regressor
+    num = min(len(saved['y']), len(y))
+    changed = np.flatnonzero(saved['y'][:num] != y[:num])
+    num_valid = changed[0] if len(changed) else num
+    changed = np.flatnonzero((saved['x'][:num] != x[:num]).any(axis=1))
+    num_valid = min(num_valid, changed[0] if len(changed) else num)
+    state = {k[len('state_'):]: v for k, v in saved.items() if k.startswith('state_')}
+    return num_valid, saved['mean'], saved['std'], saved['params'], state
+
+
+def _save_retrospective(cache, y, x, first, refit_every, horizon, mean, std,
+                        params, spec=MODEL_SPEC, state=None):
+    """Persist retrospective() results, see _load_retrospective()"""
+    state = {'state_' + k: v for k, v in (state or {}).items()}
+    tmp = cache + '.tmp.npz'
+    np.savez(tmp, spec=spec, first=first, refit_every=refit_every,
+             horizon=horizon, y=y, x=x, mean=mean, std=std, params=params,
+             **state)
+    os.replace(tmp, cache)
+
+
+def _retrospective_chunk(y, x, dow, origins, refit_every, horizon, params):
+    """
+    Fit and forecast one chunk of timesteps for retrospective()
+
+    Runs in a worker process when retrospective() is parallel, so takes plain
+    arrays rather than the model or dataframe.
+
+    Arguments:
+        y, x, dow: model inputs, as returned by features()
+        origins: list of int, timesteps at which to refit, in order
+        refit_every: int, number of timesteps between model fits
+        horizon: int, number of steps to forecast from each origin
+        params: array or None, starting values for the first fit, later fits
+            are warm-started from the previous fit
+
+    Returns: first, mean, std, params, fit_sec
+        first: int, first timestep in chunk
+        mean, std: 2D arrays, forecasts from origins first to
+            first + len(mean), one column per horizon
+        params: array, parameters from the last fit
+        fit_sec: list of float, wall time of each fit and forecast
+    """
+    mod = _get_model(y, x)
+    num_data = len(y)
+    last = min(origins[-1] + refit_every, num_data)
+    mean = np.zeros((last - origins[0], horizon))
+    std = np.zeros((last - origins[0], horizon))
+    fit_sec = []
+    for ii in origins:
+        tic = perf_counter()
+        res = mod.fit(last_obs=ii+1, disp='off', starting_values=params)
+        params = res.params.values
+        end = min(ii + refit_every, num_data)
+        # all origins and horizons up to the next refit at once
+        steps = np.arange(ii, end)
+        frc_mean, frc_var = _garch_forecast(
+            params, y, x, ii+1, steps, _future_exog(x, dow, steps, horizon))
+        mean[ii-origins[0]:end-origins[0]] = frc_mean
+        std[ii-origins[0]:end-origins[0]] = np.sqrt(frc_var)
+        fit_sec.append(perf_counter() - tic)
+    return origins[0], mean, std, params, fit_sec
+
+
+def forecast_metrics(obs, mean, std, step=1):
+    """
+    Return accuracy metrics for retrospective forecasts
+
+    Arguments:
+        obs: array of observed values
+        mean, std: arrays of forecasts, as returned by retrospective(), NaN
+            where no forecast was made, mean[t] is the forecast of
+            obs[t+step], for multi-horizon results pass one column
+        step: int, forecast horizon of mean and std
+
+    Returns: dict with the following fields:
+        num: number of timesteps with a forecast
+        rmse: root-mean-square error
+        mae: mean absolute error
+        bias: mean error (observed - predicted)
+        coverage_1sigma: fraction of observations within mean +/- std
+    """
+    obs = np.asarray(obs, dtype=float)[step:]
+    mean = mean[:-step]
+    std = std[:-step]
+    valid = ~np.isnan(mean) & ~np.isnan(obs)
+    err = obs[valid] - mean[valid]
+    if not len(err):
+        return {'num': 0, 'rmse': np.nan, 'mae': np.nan, 'bias': np.nan,
+                'coverage_1sigma': np.nan}
+    return {
+        'num': int(len(err)),
+        'rmse': float(np.sqrt(np.mean(err**2))),
+        'mae': float(np.mean(np.abs(err))),
+        'bias': float(np.mean(err)),
+        'coverage_1sigma': float(np.mean(np.abs(err) <= std[valid])),
+        }
+
+
+def retrospective(data, first=500,  disp=True, refit_every=1, cache=None,
+                  n_jobs=1, chunk_size=RETROSPECTIVE_CHUNK, stats=None,
+                  engine='garch', horizon=1):
     """
     Return retrospective forecast for all timesteps in dataset
 
     For each timestep, train the model on all prior data and perform 1-step
-    forecast. The forecast returns both mean (expected value) and variance.
+    forecast, or forecasts for steps 1 to horizon, which are computed
+    together for all origins between refits. The forecast returns both mean
+    (expected value) and variance.
+
+    Timesteps are split into chunks of consecutive model fits. Within a
+    chunk, each fit is warm-started from the parameters of the previous fit.
+    Chunks are independent, and can be run in parallel processes; results
+    depend on chunk_size but not on n_jobs. With refit_every > 1, the model
+    is refit only every k timesteps, and forecasts in between use the latest
+    parameters, filtered forward over the new observations. If a cache file
+    is given, results are persisted there and timesteps whose input data is
+    unchanged are not recomputed. See forecast_metrics() to score results.
 
     Arguments:
         data: pandas Dataframe read from sheet
         first: int, index of first timestep to forecast
-        disp: int or None, interval for printing update message
+        disp: bool, set True to log progress as chunks complete
+        refit_every: int, number of timesteps between model fits
+        cache: path to .npz file to persist results, or None
+        n_jobs: int, number of worker processes, 1 to run in this process
+        chunk_size: int, number of model fits per chunk
+        stats: dict or None, if set, 'fit_sec' is set to an array of the wall
+            time of each model fit and forecast, or for recursive engines,
+            each forecast and update
+        engine: string, 'garch' for the GARCH model, or a key in ENGINES for a
+            recursive engine, which ignores all other options except first,
+            horizon, cache and stats
+        horizon: int, number of steps to forecast from each origin
     Returns: mean, std
         mean: forecasted mean value
         std: forecasted standard deviation
+        For horizon > 1, both are 2D arrays, with column h-1 holding the
+        h-step forecast from each origin
     """
-    logger.info('Retrospective forecast')
-    
-    # prepare model
-    mod = get_model(data)
+    logger.info('Retrospective forecast, engine: {}'.format(engine))
+
+    feats = features(data)
+    if engine != 'garch':
+        mean, std, fit_sec = _engine_retrospective(
+            engine, feats, first, horizon, cache)
+        if stats is not None:
+            stats['fit_sec'] = np.array(fit_sec)
+        if horizon == 1:
+            return mean[:, 0], std[:, 0]
+        return mean, std
+
+    y, x, dow = feats.y, feats.x, feats.dow
 
     # allocate results vectors
-    num_data = len(mod.y)
-    mean = np.zeros(num_data)
-    mean[:] = np.nan
-    std = np.zeros(num_data)
-    std[:] = np.nan
-
-    # perform retrospective forecast at all timesteps
-    for ii in range(first, num_data):
-        if disp and ii % disp == 0:
-            logger.info('Forecasting {} of {}'.format(ii, num_data))
-        res = mod.fit(last_obs=ii+1, disp='off')
-        frc = res.forecast(horizon=1)
-        mean[ii] = frc.mean['h.1'][ii]
-        std[ii] = np.sqrt(frc.variance['h.1'][ii])
+    num_data = len(y)
+    mean = np.full((num_data, horizon), np.nan)
+    std = np.full((num_data, horizon), np.nan)
 
+    # reuse persisted results, resuming at the last refit before new data
+    num_valid, old_mean, old_std, params, _ = _load_retrospective(
+        cache, y, x, first, refit_every, horizon)
+    start = first
+    if num_valid > first:
+        start = first + ((num_valid - first) // refit_every) * refit_every
+        mean[:start] = old_mean[:start]
+        std[:start] = old_std[:start]
+        logger.info('Reusing {} cached forecast timesteps'.format(start - first))
+
+    # split refit timesteps into chunks, only the first resumes from the cache
+    origins = list(range(start, num_data, refit_every))
+    chunks = [origins[ii:ii+chunk_size] for ii in range(0, len(origins), chunk_size)]
+    chunk_params = [params] + [None] * (len(chunks) - 1)
+    fit_sec = [None] * len(chunks)
+
+    def store(ii, result, num_done):
+        chunk_first, chunk_mean, chunk_std, last_params, fit_sec[ii] = result
+        mean[chunk_first:chunk_first+len(chunk_mean)] = chunk_mean
+        std[chunk_first:chunk_first+len(chunk_std)] = chunk_std
+        if disp:
+            logger.info('Forecast chunk {} of {} complete'.format(num_done, len(chunks)))
+        return last_params
+
+    results = {}
+    if n_jobs == 1:
+        for ii, chunk in enumerate(chunks):
+            results[ii] = store(ii, _retrospective_chunk(
+                y, x, dow, chunk, refit_every, horizon, chunk_params[ii]), ii + 1)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {pool.submit(_retrospective_chunk, y, x, dow, chunk,
+                                   refit_every, horizon, chunk_params[ii]): ii
+                       for ii, chunk in enumerate(chunks)}
+            for num_done, future in enumerate(as_completed(futures), 1):
+                ii = futures[future]
+                results[ii] = store(ii, future.result(), num_done)
+
+    if stats is not None:
+        stats['fit_sec'] = np.array([t for chunk in fit_sec for t in chunk])
+
+    if cache and chunks:
+        params = results[len(chunks) - 1]
+        _save_retrospective(cache, y, x, first, refit_every, horizon, mean,
+                            std, params)
+
+    if horizon == 1:
+        return mean[:, 0], std[:, 0]
     return mean, std
 
 
-def tomorrow(data):
+def _fingerprint(y, x, spec=MODEL_SPEC):
+    """Return hash of model spec, observations 'y' and regressors 'x'"""
+    sha = hashlib.sha1(spec.encode('utf-8'))
+    sha.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def _quantile_column(q):
+    """Return forecast table column name for quantile 'q', e.g. 'q05'"""
+    return 'q{:02.0f}'.format(100 * q)
+
+
+def ahead(data, horizon=FORECAST_HORIZON, quantiles=FORECAST_QUANTILES,
+          cache=None, engine='garch'):
+    """
+    Return forecast table for the days after the last row of the sheet
+
+    All horizons come from a single model fit. If a cache file is given, the
+    fitted parameters are stored there, keyed on a fingerprint of the data
+    and model spec. For unchanged data the cached parameters are used without
+    fitting, and if only new observations were appended, the cached
+    parameters are updated with a short warm-started fit rather than a full
+    optimization. Recursive engines cache their state instead, see
+    _engine_ahead().
+
+    Arguments:
+        data: pandas Dataframe read from sheet
+        horizon: int, number of days to forecast
+        quantiles: list of float, quantiles of the (normal) forecast
+            distribution to include
+        cache: path to JSON file to cache fitted model, or None
+        engine: string, 'garch' for the GARCH model, or a key in ENGINES for a
+            recursive engine
+
+    Returns: pandas Dataframe indexed by forecast date, with columns
+        'HORIZON' (days after the last row), 'MEAN', 'STD', and one column
+        per quantile, e.g. 'q05'
+    """
+    logger.info('{}-day forecast, engine: {}'.format(horizon, engine))
+
+    feats = features(data)
+    if engine != 'garch':
+        mean, std = _engine_ahead(engine, feats, horizon, cache)
+    else:
+        y, x, dow = feats.y, feats.x, feats.dow
+        mod = get_model(data, feats)
+        fingerprint = _fingerprint(y, x)
+
+        saved = None
+        if cache and os.path.isfile(cache):
+            with open(cache, 'r') as fp:
+                saved = json.load(fp)
+
+        if saved and saved['fingerprint'] == fingerprint:
+            logger.info('Using cached fit')
+            params = np.array(saved['params'])
+        else:
+            if (saved and saved['num_obs'] < len(y)
+                    and saved['fingerprint'] == _fingerprint(
+                        y[:saved['num_obs']], x[:saved['num_obs']])):
+                logger.info('Updating cached fit with {} new observations'.format(
+                            len(y) - saved['num_obs']))
+                res = mod.fit(disp='off', starting_values=np.array(saved['params']),
+                              options={'maxiter': TOMORROW_UPDATE_MAXITER})
+            else:
+                res = mod.fit(disp='off')
+            params = res.params.values
+            if cache:
+                with open(cache + '.tmp', 'w') as fp:
+                    json.dump({'fingerprint': fingerprint, 'num_obs': len(y),
+                               'params': params.tolist()}, fp)
+                os.replace(cache + '.tmp', cache)
+
+        origin = [len(y) - 1]
+        mean, var = _garch_forecast(params, y, x, len(y), origin,
+                                    _future_exog(x, dow, origin, horizon))
+        mean = mean[0]
+        std = np.sqrt(var[0])
+
+    steps = np.arange(1, horizon + 1)
+    table = pd.DataFrame(
+        {'HORIZON': steps, 'MEAN': mean, 'STD': std},
+        index=data.index[-1] + pd.to_timedelta(steps, unit='D'))
+    for q in quantiles:
+        table[_quantile_column(q)] = mean + norm.ppf(q) * std
+    return table
+
+
+def tomorrow(data, cache=None, engine='garch'):
     """
     Return forecasted attendence for tomorrow
 
+    This is the 2-day forecast from the last row of the sheet, see ahead().
+
     Arguments:
         data: pandas Dataframe read from sheet
+        cache: path to JSON file to cache fitted model, or None
+        engine: string, 'garch' for the GARCH model, or a key in ENGINES for a
+            recursive engine
     Returns: mean, std
         mean: forecasted mean value
         std: forecasted standard deviation
     """
-    logger.info('Tommorow forecast')
-
-    mod = get_model(data)
-    res = mod.fit(disp='off')
-    frc = res.forecast(horizon=2)
-    mean = frc.mean['h.2'].values[-1]
-    std = np.sqrt(frc.variance['h.2'].values[-1])
-    return mean, std
-
+    row = ahead(data, horizon=2, quantiles=[], cache=cache, engine=engine).iloc[-1]
+    return float(row['MEAN']), float(row['STD'])
@@ -0,0 +1,170 @@
+"""
+Bokeh plots shared by the MV Polar Bears website and blog post
+"""
+
+from bokeh import plotting as bk_plt
+from bokeh import models as bk_model
+from bokeh import embed as bk_embed
+import logging
+import numpy as np
+import pandas as pd
+
+# constants
+GROUP_COLOR = 'royalblue'
+NEWBIES_COLOR = 'forestgreen'
+FONT_SIZE = '12pt'
+DAY_TO_MSEC = 60*60*24*1000
+PLOT_DAILY_DAYS = 180 # most recent days plotted at daily resolution
+PLOT_WEEKLY_DAYS = 730 # older days up to this age are binned weekly, then monthly
+
+
+# init logging
+logger = logging.getLogger('mv-polar-bears')
+
+
+def set_font_size(fig):
+    """Update font sizes in input Bokeh figures"""
+    fig.title.text_font_size = FONT_SIZE
+    fig.xaxis.axis_label_text_font_size = FONT_SIZE
+    fig.yaxis.axis_label_text_font_size = FONT_SIZE
+    fig.xaxis.major_label_text_font_size = FONT_SIZE
+    fig.yaxis.major_label_text_font_size = FONT_SIZE
+    fig.legend.label_text_font_size = FONT_SIZE
+
+
+def set_ylabel_to_positive(fig):
+    """Replace negative-valued y labels with thier absolute value"""
+    fig.yaxis.formatter = bk_model.FuncTickFormatter(code="return Math.abs(tick)")
+
+
+def format_legend(fig):
+    """Simple legend formatting"""
+    fig.legend.location = "top_left"
+
+
+def attendance_bins(data, daily_days=PLOT_DAILY_DAYS, weekly_days=PLOT_WEEKLY_DAYS):
+    """
+    Aggregate daily attendance into time bins for plotting
+
+    Recent days are kept at daily resolution, older days are binned by week
+    and then by month, so the number of bins grows slowly with the length of
+    the history.
+
+    Arguments:
+        data: pandas dataframe
+        daily_days: int, number of most recent days to keep at daily
+            resolution, set None to keep all days
+        weekly_days: int, days older than daily_days and younger than this
+            are binned by week, older days by month
+
+    Returns: dict of numpy arrays, one element per bin, with keys:
+        x: bin center, msec since epoch (local time)
+        width: bin width, msec
+        group, newbies: mean daily attendance in bin
+        cumul_group, cumul_newbies: cumulative attendance at end of bin
+        newbies and cumul_newbies are negated, to plot below the axis
+    """
+    day = data.index.tz_localize(None).normalize()
+    grp = pd.to_numeric(data['GROUP'], errors='coerce').fillna(0).values
+    newb = pd.to_numeric(data['NEWBIES'], errors='coerce').fillna(0).values
+
+    # bin start for each day, by age
+    if daily_days is None:
+        start = day
+    else:
+        age = (day[-1] - day).days
+        week = day - pd.to_timedelta(day.dayofweek, unit='D')
+        month = day.to_period('M').to_timestamp()
+        start = np.where(age < daily_days, day.values,
+                         np.where(age < weekly_days, week.values, month.values))
+
+    frame = pd.DataFrame({
+        'start': start, 'day': day.values, 'group': grp, 'newbies': newb,
+        'cumul_group': grp.cumsum(), 'cumul_newbies': newb.cumsum()})
+    bins = frame.groupby('start', sort=True).agg({
+        'day': ['min', 'max'], 'group': 'mean', 'newbies': 'mean',
+        'cumul_group': 'last', 'cumul_newbies': 'last'})
+
+    first = bins[('day', 'min')].values.astype('datetime64[ms]').astype(np.float64)
+    last = bins[('day', 'max')].values.astype('datetime64[ms]').astype(np.float64)
+    width = last - first + DAY_TO_MSEC
+    return {
+        'x': first + width / 2,
+        'width': width,
+        'group': bins[('group', 'mean')].values.astype(np.float32),
+        'newbies': -bins[('newbies', 'mean')].values.astype(np.float32),
+        'cumul_group': bins[('cumul_group', 'last')].values.astype(np.float32),
+        'cumul_newbies': -bins[('cumul_newbies', 'last')].values.astype(np.float32),
+        }
+
+
+def _attendance_figure(source, x_range, width, height, title, y_label,
+                       top, bottom, group_label):
+    """Return bar plot of group (above axis) and newbies (below axis)"""
+    fig = bk_plt.figure(
+        title=title,
+        x_axis_label='Date',
+        x_axis_type='datetime',
+        x_range=x_range,
+        y_axis_label=y_label,
+        plot_width=width,
+        plot_height=height,
+        tools="pan,wheel_zoom,box_zoom,reset",
+        logo=None
+        )
+
+    # add bar plots
+    fig.vbar(
+        x='x', width='width', bottom=0, top=top, source=source,
+        color=GROUP_COLOR, legend=group_label)
+    fig.vbar(
+        x='x', width='width', bottom=bottom, top=0, source=source,
+        color=NEWBIES_COLOR, legend='Newbies')
+
+    # additional formatting
+    set_font_size(fig)
+    set_ylabel_to_positive(fig)
+    format_legend(fig)
+
+    return fig
+
+
+def attendance_plots(data, width, height, group_label='Bears',
+                     cumul_title='Cumulative Total Attendence',
+                     cumul_y_label='# Attendees', daily_days=PLOT_DAILY_DAYS,
+                     weekly_days=PLOT_WEEKLY_DAYS):
+    """
+    Plot daily and cumulative attendance
+
+    Both figures share a single ColumnDataSource of binned numeric arrays
+    (see attendance_bins()), which Bokeh embeds in the page base64-encoded,
+    and a single x range, so they pan and zoom together.
+
+    Arguments:
+        data: pandas dataframe
+        width, height: int, plot size in pixels
+        group_label: string, legend label for the GROUP column
+        cumul_title, cumul_y_label: strings, labels for the cumulative plot
+        daily_days, weekly_days: binning options, see attendance_bins()
+
+    Returns: script, (daily_div, cumul_div)
+        script: javascript function controlling both plots, wrapped in
+            <script> HTML tags
+        daily_div, cumul_div: HTML <div> modified by javascript to show plots
+    """
+    logger.info('Generating daily and cumulative attendance plots')
+
+    bins = attendance_bins(data, daily_days, weekly_days)
+    source = bk_model.ColumnDataSource(data=bins)
+    x_range = bk_model.Range1d(bins['x'][0] - bins['width'][0] / 2,
+                               bins['x'][-1] + bins['width'][-1] / 2)
+    logger.info('Plotting {} days in {} bins'.format(len(data), len(bins['x'])))
+
+    daily = _attendance_figure(
+        source, x_range, width, height, 'Daily Attendence', '# Attendees',
+        'group', 'newbies', group_label)
+    cumul = _attendance_figure(
+        source, x_range, width, height, cumul_title, cumul_y_label,
+        'cumul_group', 'cumul_newbies', group_label)
+
+    return bk_embed.components((daily, cumul))
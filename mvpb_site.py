@@ -3,13 +3,16 @@ Build website for MV Polar Bears facebook app
 """
 
 import os
-from mvpb_util import get_client, read_sheet
+import glob
+from mvpb_util import get_client, read_sheet_incremental, get_table_data
+from mvpb_util import file_digest, frame_digest, write_if_changed
+from mvpb_util import get_template_env, render_templates
+from mvpb_util import content_digest, minify_html, write_precompressed
+from mvpb_util import remove_precompressed, PRECOMPRESSED_EXTS
+from bokeh.util.paths import bokehjsdir
 from mvpb_data import get_weather_conditions, get_water_conditions
-from bokeh import plotting as bk_plt
-from bokeh import models as bk_model
-from bokeh import embed as bk_embed
-from bokeh import layouts as bk_layouts
-import jinja2
+import mvpb_plot
+from mvpb_plot import attendance_plots
 import pytz
 import dateutil
 from numpy import nan
@@ -21,19 +24,21 @@ from datetime import datetime, timedelta
 import json
 import numpy as np
 import pandas as pd
-import shutil
 
 # constants
 TEMPLATES_DIR = 'templates'
 WEBPAGE_TITLE = 'MV Polar Bears!'
-GROUP_COLOR = 'royalblue'
-NEWBIES_COLOR = 'forestgreen'
-FONT_SIZE = '12pt'
-DAY_TO_MSEC = 60*60*24*1000
 US_EASTERN = pytz.timezone('US/Eastern')
 PLOT_WIDTH = 612 
 PLOT_HEIGHT = 300
 NUM_RECENT = 4
+TABLE_COLUMNS = ['DATE', 'DAY-OF-WEEK', 'GROUP', 'NEWBIES'] # used in index.html
+SITE_MANIFEST = os.path.join('data', 'site-manifest.json')
+PAGES = ['index.html', 'privacy.html', 'tos.html'] # rendered from templates
+STATIC_FILES = ['style.css'] # copied from templates
+BUNDLE_JS = os.path.join('js', 'bokeh.min.js') # BokehJS pieces used, relative
+BUNDLE_CSS = os.path.join('css', 'bokeh.min.css') # ... to the bokehjs dir
+BUNDLE_JS_GLOB = 'bokeh-*.min.js*' # fingerprinted BokehJS, see write_bundle()
 #NUM_RECENT_PLOT = int(365*1.5)
 
 
@@ -41,152 +46,129 @@ NUM_RECENT = 4
 logger = logging.getLogger('mv-polar-bears')
 
 
-def set_font_size(fig):
-    """Update font sizes in input Bokeh figures"""
-    fig.title.text_font_size = FONT_SIZE
-    fig.xaxis.axis_label_text_font_size = FONT_SIZE
-    fig.yaxis.axis_label_text_font_size = FONT_SIZE
-    fig.xaxis.major_label_text_font_size = FONT_SIZE
-    fig.yaxis.major_label_text_font_size = FONT_SIZE
-    fig.legend.label_text_font_size = FONT_SIZE
+def _read_manifest(path):
+    """Return build manifest at 'path', or an empty manifest if missing"""
+    if not os.path.isfile(path):
+        return {'plots': {}, 'outputs': {}}
+    with open(path, 'r') as fp:
+        return json.load(fp)
 
 
-def set_ylabel_to_positive(fig):
-    """Replace negative-valued y labels with thier absolute value"""
-    fig.yaxis.formatter = bk_model.FuncTickFormatter(code="return Math.abs(tick)")
+def _is_current(manifest, path, inputs):
+    """Return True if output file exists and was built from 'inputs'"""
+    entry = manifest['outputs'].get(path)
+    return bool(entry and entry['inputs'] == inputs
+                and file_digest(path) == entry['digest'])
 
 
-def format_legend(fig):
-    """Simple legend formatting"""
-    fig.legend.location = "top_left"
+def _record_output(manifest, path, inputs, written):
+    """Record output file in build manifest"""
+    manifest['outputs'][path] = {'inputs': inputs, 'digest': file_digest(path)}
+    logger.info('{} {}'.format('Wrote' if written else 'Unchanged', path))
 
 
-def daily_bar_plot(data, limit=None):
+def get_index_context(data, manifest, plot_inputs, rebuild=False):
     """
+    Return template variables for index.html
+
     Arguments:
         data: pandas dataframe
-        limit: int, max number of results to include, set None to include all
-
-    Returns: script, div
-        script: javascript function controlling plot, wrapped in <script> HTML tags
-        div: HTML <div> modified by javascript to show plot
+        manifest: dict, build manifest, cached plots are read and updated
+        plot_inputs: dict, content digest of each input to the plots
+        rebuild: bool, set True to regenerate plots regardless
     """
-    logger.info('Generating daily bar plot')
-
-    # truncate data, if requested
-    if not limit:
-        limit = 0
-    time = data.index[-limit:]
-    grp = data['GROUP'][-limit:]
-    newb = data['NEWBIES'][-limit:]
-
-    # create figure
-    fig = bk_plt.figure(
-        title="Daily Attendence",
-        x_axis_label='Date',
-        x_axis_type='datetime',
-        x_range=(time[0], time[-1]),
-        y_axis_label='# Attendees',
-        plot_width=PLOT_WIDTH,
-        plot_height=PLOT_HEIGHT,
-        tools="pan,wheel_zoom,box_zoom,reset",
-        logo=None
+    total_attendees = int(data['GROUP'].fillna(0).sum())
+    total_bears = int(data['NEWBIES'].fillna(0).sum())
+
+    daily_table = list(get_table_data(data, NUM_RECENT, TABLE_COLUMNS))
+
+    # plot components embed random ids, so reuse them for unchanged data
+    plots = manifest['plots']
+    if rebuild or plots.get('inputs') != plot_inputs:
+        plots['attendance'] = attendance_plots(data, PLOT_WIDTH, PLOT_HEIGHT)
+        plots['inputs'] = plot_inputs
+    attendance_script, (daily_bar_div, cumul_div) = plots['attendance']
+
+    return dict(
+        title=WEBPAGE_TITLE,
+        daily_table=daily_table[::-1],
+        daily_bar_div=daily_bar_div, cumul_div=cumul_div,
+        attendance_script=attendance_script,
+        last_update=datetime.now(pytz.timezone('US/Eastern')).strftime('%Y-%m-%d %H:%M:%S'),
+        total_bears=total_bears,
+        total_attendees=total_attendees,
         )
-    
-    # add bar plots
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=0, top=grp,
-        color=GROUP_COLOR, legend='Bears')
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=-newb, top=0,
-        color=NEWBIES_COLOR, legend='Newbies')
 
-    # additional formatting
-    set_font_size(fig)
-    set_ylabel_to_positive(fig)
-    format_legend(fig)
 
-    return bk_embed.components(fig)
+def _prune_bundle_js(pub_dir, keep=None):
+    """Delete fingerprinted BokehJS files, and siblings, except for 'keep'"""
+    for path in glob.glob(os.path.join(pub_dir, BUNDLE_JS_GLOB)):
+        name = os.path.basename(path)
+        for ext in PRECOMPRESSED_EXTS:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        if name != keep:
+            logger.info('Removing stale {}'.format(path))
+            os.remove(path)
 
 
-def cumul_bears_plot(data):
+def write_bundle(env, path, context):
     """
-    Arguments:
-        data: pandas dataframe
+    Render index.html as a self-contained, minified page
 
-    Returns: script, div
-        script: javascript function controlling plot, wrapped in <script> HTML tags
-        div: HTML <div> modified by javascript to show plot
-    """
-    logger.info('Generating cumulative bears plot')
-
-    # prep data
-    time = data.index.values
-    grp = data['GROUP'].fillna(0).cumsum()
-    newb = data['NEWBIES'].fillna(0).cumsum()
-
-    # create figure
-    fig = bk_plt.figure(
-        title='Cumulative Total Attendence',
-        x_axis_label='Date',
-        x_axis_type='datetime',
-        x_range=(time[0], time[-1]),
-        y_axis_label='# Attendees',
-        plot_width=PLOT_WIDTH,
-        plot_height=PLOT_HEIGHT,
-        tools="pan,wheel_zoom,box_zoom,reset",
-        logo=None
-        )
-    
-    # plot bars
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=0, top=grp,
-        color=GROUP_COLOR, legend='Bears')
-    fig.vbar(
-        x=time, width=DAY_TO_MSEC, bottom=-newb, top=0,
-        color=NEWBIES_COLOR, legend='Newbies')
-
-    # additional formatting
-    set_font_size(fig)
-    set_ylabel_to_positive(fig)
-    format_legend(fig)
+    CSS (BokehJS and style.css) is inlined, and BokehJS is written next to
+    the page under a content-fingerprinted name, so it can be cached by
+    browsers indefinitely, and BokehJS files with other fingerprints are
+    deleted. Precompressed siblings are written for both.
 
-    return bk_embed.components(fig)
-
-
-def get_table_data(data):
-    """
-    Munge data to build a daily view of all available data
-    
     Arguments:
-        data: pandas dataframe
+        env: Jinja2 environment, see get_template_env()
+        path: path to output page
+        context: template variables, as returned by get_index_context()
 
-    Returns:
-        list of dicts, each containing data for a single day, with no gaps
+    Returns: bool, True if the page was written
     """
-    logger.info('Generating summary table')
-
-    table_dict = data.T.to_dict()
-    table = []
-    for date in sorted(data.index):
-        table.append(table_dict[date])
-    table.sort(key=lambda x: x['DATE'], reverse=True)
-    for ii in range(len(table)):
-        for k, v in table[ii].items():
-            if pd.isnull(v):
-                table[ii][k] = None
-    return table
-
-
-def update(google_keyfile, pub_dir, log_level):
+    with open(os.path.join(bokehjsdir(), BUNDLE_JS), 'rb') as fp:
+        js = fp.read()
+    js_name = 'bokeh-{}.min.js'.format(content_digest(js)[:10])
+    write_precompressed(os.path.join(os.path.dirname(path), js_name), js)
+    _prune_bundle_js(os.path.dirname(path), keep=js_name)
+
+    css = []
+    for css_path in [os.path.join(bokehjsdir(), BUNDLE_CSS),
+                     os.path.join(TEMPLATES_DIR, 'style.css')]:
+        with open(css_path, 'r') as fp:
+            css.append(fp.read())
+
+    html = env.get_template('index.html').render(
+        bundle_js=js_name, bundle_css='\n'.join(css), **context)
+    return write_precompressed(path, minify_html(html))
+
+
+def update(google_keyfile, pub_dir, log_level, local_sheet=None,
+           full_resync=False, rebuild=False, manifest_path=SITE_MANIFEST,
+           bundle=False):
     """
     Get data and build static HTML / JS site
+
+    The build is incremental: the content digest of each input (sheet data,
+    templates, static files) is recorded in a manifest, and outputs whose
+    inputs are unchanged are not regenerated. Files are only written, always
+    atomically, if their content differs.
     
     Arguments:
         google_keyfile: Google Sheets API key
         pub_dir: Directory to publish output files to
         log_level: string, logging level, one of 'critical', 'error',
             'warning', 'info', 'debug'
+        local_sheet: path to CSV file to read in place of the Google sheet,
+            or None to use the Google sheet
+        full_resync: bool, set True to read the full sheet rather than only
+            rows changed since the last run
+        rebuild: bool, set True to regenerate all outputs
+        manifest_path: path to JSON build manifest
+        bundle: bool, set True to build index.html as a self-contained,
+            minified page with no CDN requests, see write_bundle()
     """
     lvl = getattr(logging, log_level.upper())
     logging.basicConfig(level=lvl)
@@ -194,44 +176,63 @@ def update(google_keyfile, pub_dir, log_level):
 
     logger.info('Updating MV Polar Bears website')
 
-    client, doc, sheet = get_client(google_keyfile)
-    data = read_sheet(sheet) 
-
-    total_attendees = int(data['GROUP'].fillna(0).sum())
-    total_bears = int(data['NEWBIES'].fillna(0).sum())
-    
-    daily_table = get_table_data(data)
-    daily_bar_script, daily_bar_div = daily_bar_plot(data)
-    cumul_script, cumul_div = cumul_bears_plot(data)
-
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
-        )
+    client, doc, sheet = get_client(google_keyfile, local_sheet)
+    data = read_sheet_incremental(sheet, full=full_resync)
+    manifest = _read_manifest(manifest_path)
+    plot_inputs = {'data': frame_digest(data),
+                   'mvpb_plot.py': file_digest(mvpb_plot.__file__)}
 
     if not os.path.isdir(pub_dir):
         os.makedirs(pub_dir)
 
-    site_template = env.get_template('index.html')
-    with open(os.path.join(pub_dir, 'index.html'), 'w') as site_fp:
-        site_content = site_template.render(
-            title=WEBPAGE_TITLE,
-            daily_table=daily_table[:NUM_RECENT][::-1],
-            daily_bar_div=daily_bar_div, daily_bar_script=daily_bar_script,
-            cumul_div=cumul_div, cumul_script=cumul_script,
-            last_update=datetime.now(pytz.timezone('US/Eastern')).strftime('%Y-%m-%d %H:%M:%S'),
-            total_bears=total_bears,
-            total_attendees=total_attendees,
-            )
-        site_fp.write(site_content)
-    
-    shutil.copyfile(os.path.join(TEMPLATES_DIR, 'style.css'),
-                    os.path.join(pub_dir, 'style.css'))
-
-    shutil.copyfile(os.path.join(TEMPLATES_DIR, 'privacy.html'),
-                    os.path.join(pub_dir, 'privacy.html'))
-
-    shutil.copyfile(os.path.join(TEMPLATES_DIR, 'tos.html'),
-                    os.path.join(pub_dir, 'tos.html'))
+    # find outputs with changed inputs
+    inputs = {name: {name: file_digest(os.path.join(TEMPLATES_DIR, name))}
+              for name in PAGES + STATIC_FILES}
+    inputs['index.html'].update(plot_inputs)
+    if bundle:
+        inputs['index.html'].update({
+            'bundle': True,
+            'style.css': inputs['style.css']['style.css'],
+            BUNDLE_JS: file_digest(os.path.join(bokehjsdir(), BUNDLE_JS)),
+            BUNDLE_CSS: file_digest(os.path.join(bokehjsdir(), BUNDLE_CSS))})
+    paths = {name: os.path.join(pub_dir, name) for name in inputs}
+    stale = [name for name in PAGES + STATIC_FILES
+             if rebuild or not _is_current(manifest, paths[name], inputs[name])]
+    for name in [name for name in PAGES + STATIC_FILES if name not in stale]:
+        logger.info('Skipping unchanged {}'.format(paths[name]))
+
+    # render pages in one pass
+    context = {}
+    if 'index.html' in stale:
+        context = get_index_context(data, manifest, plot_inputs, rebuild)
+    env = get_template_env(TEMPLATES_DIR)
+    pages = {name: paths[name] for name in PAGES if name in stale}
+    if bundle and 'index.html' in pages:
+        del pages['index.html']
+        written = render_templates(env, pages, **context)
+        written['index.html'] = write_bundle(env, paths['index.html'], context)
+    else:
+        written = render_templates(env, pages, **context)
+
+    # remove leftovers of a previous bundled build
+    if not bundle:
+        remove_precompressed(paths['index.html'])
+        _prune_bundle_js(pub_dir)
+
+    # copy static files
+    for name in STATIC_FILES:
+        if name in stale:
+            with open(os.path.join(TEMPLATES_DIR, name), 'rb') as fp:
+                written[name] = write_if_changed(paths[name], fp.read())
+
+    for name in stale:
+        _record_output(manifest, paths[name], inputs[name], written[name])
+
+    if os.path.dirname(manifest_path) and not os.path.isdir(os.path.dirname(manifest_path)):
+        os.makedirs(os.path.dirname(manifest_path))
+    with open(manifest_path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(manifest_path + '.tmp', manifest_path)
 
     logger.info('Update complete')
 
@@ -249,7 +250,20 @@ if __name__ == '__main__':
     ap.add_argument('--log_level', help='Log level to display',
                     choices=['critical', 'error', 'warning', 'info', 'debug'],
                     default='info')
+    ap.add_argument('--local_sheet', default=None,
+                    help='Path to CSV file to read instead of the Google '
+                         'sheet, google_key is ignored if set')
+    ap.add_argument('--full_resync', action='store_true',
+                    help='Read the full sheet, not just rows changed since '
+                         'the last run')
+    ap.add_argument('--rebuild', action='store_true',
+                    help='Regenerate all output files, even if their inputs '
+                         'are unchanged')
+    ap.add_argument('--bundle', action='store_true',
+                    help='Build a self-contained, minified index.html, with '
+                         'local BokehJS and precompressed copies')
     args = ap.parse_args()
 
     # run
-    update(args.google_key, args.pub_dir, args.log_level) 
+    update(args.google_key, args.pub_dir, args.log_level, args.local_sheet,
+           args.full_resync, args.rebuild, bundle=args.bundle) 
@@ -3,39 +3,214 @@ Shared utilites for MV Polar Bears project
 """
 
 import os
+import re
+import csv
+import json
+import time
+import hashlib
+import pickle
+import requests
+import filecmp
+import gzip
+import io
+import jinja2
 import gspread
+from gspread.utils import numericise_all, a1_to_rowcol
 from oauth2client.service_account import ServiceAccountCredentials
 from numpy import nan
 import pandas as pd
 import pytz
 import dateutil
+from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pdb import set_trace
+import logging
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # constants
 DOC_TITLE = 'MV Polar Bears'
 SHEET_TITLE = 'Data'
 US_EASTERN = pytz.timezone('US/Eastern')
+SHEET_DATETIME_FORMAT = '%Y-%m-%d %I:%M %p' # DATE + ' ' + TIME, as written by mvpb_data
+HTTP_CACHE_META_EXT = '.meta.json'
+SHEET_SNAPSHOT_DIR = 'data' # local copies of sheet values, by sheet title
+SHEET_SNAPSHOT_OVERLAP = 7 # rows re-read before the end of the snapshot
+SHEET_SNAPSHOT_META_EXT = '.meta.json' # high-water mark, beside snapshot
+PRECOMPRESSED_EXTS = ['.gz', '.br'] # siblings written by write_precompressed
+STAGE_CACHE_KEY_EXT = '.key' # input digest, beside cached stage results
+TEMPLATE_CACHE_DIR = os.path.join('data', 'jinja_cache') # compiled templates
+
+# init logging
+logger = logging.getLogger('mv-polar-bears')
+
+
+# Jinja2 environments, shared by all renders in a process
+_template_envs = {}
+
+
+# build stage for run_stages(), func is called with the results of deps, in
+# order, and runs on a 'thread' or in a 'process'
+Stage = namedtuple('Stage', ['func', 'deps', 'executor'])
+
+
+def _parse_datetime_text(text):
+    """Parse 'DATE TIME' string, known format first, then dateutil"""
+    try:
+        return datetime.strptime(text, SHEET_DATETIME_FORMAT)
+    except ValueError:
+        return dateutil.parser.parse(text)
 
 
 def parse_datetime(date_str, time_str):
     """Utility for parsing DATE and TIME columns to python datetime"""
-    dt = dateutil.parser.parse(date_str + ' ' + time_str) 
-    dt = dt.replace(tzinfo=US_EASTERN)
+    dt = _parse_datetime_text(date_str + ' ' + time_str)
+    dt = US_EASTERN.localize(dt)
     return dt    
 
 
-def get_client(key_file):
+def parse_datetimes(dt_text):
+    """
+    Parse series of 'DATE TIME' strings to a timezone-aware index
+
+    All values are parsed at once with the known sheet format, and only
+    values that do not match are passed to the (slow) dateutil parser.
+
+    Arguments:
+        dt_text: pd series of strings, null values are parsed as NaT
+
+    Returns: pd DatetimeIndex, in US/Eastern timezone
+    """
+    dts = pd.to_datetime(dt_text, format=SHEET_DATETIME_FORMAT, errors='coerce')
+    failed = dts.isnull() & dt_text.notnull()
+    if failed.any():
+        dts[failed] = dt_text[failed].apply(_parse_datetime_text)
+    return pd.DatetimeIndex(dts).tz_localize(US_EASTERN)
+
+
+class LocalWorksheet(object):
+    """
+    Offline stand-in for gspread.models.Worksheet, backed by a CSV file
+
+    Implements the subset of the Worksheet interface used in this project,
+    with the same semantics for row/column indices (1-based) and cell values
+    (strings on disk, numericised by get_all_records). Changes are written to
+    disk immediately.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.title = os.path.splitext(os.path.basename(self.path))[0]
+        with open(self.path, 'r', newline='') as fp:
+            self._rows = [list(row) for row in csv.reader(fp)]
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', newline='') as fp:
+            csv.writer(fp).writerows(self._rows)
+        os.replace(tmp, self.path)
+
+    def _values(self):
+        return _trim_values(self._rows)
+
+    @staticmethod
+    def _to_str(val):
+        return '' if val is None else str(val)
+
+    @property
+    def row_count(self):
+        return len(self._rows)
+
+    def get_all_values(self):
+        return self._values()
+
+    def get_all_records(self, empty2zero=False, head=1, default_blank=''):
+        data = self._values()
+        keys = data[head - 1]
+        values = [numericise_all(row, empty2zero, default_blank)
+                  for row in data[head:]]
+        return [dict(zip(keys, row)) for row in values]
+
+    def row_values(self, row):
+        try:
+            return list(self._rows[row - 1])
+        except IndexError:
+            return []
+
+    def range(self, *args):
+        if len(args) == 1:
+            start, end = args[0].split(':')
+            args = a1_to_rowcol(start) + a1_to_rowcol(end)
+        first_row, first_col, last_row, last_col = args
+        cells = []
+        for ii in range(first_row, last_row + 1):
+            row = self.row_values(ii)
+            for jj in range(first_col, last_col + 1):
+                value = row[jj - 1] if jj <= len(row) else ''
+                cells.append(gspread.models.Cell(ii, jj, value))
+        return cells
+
+    def add_rows(self, rows):
+        self._rows.extend([] for _ in range(rows))
+        self._save()
+
+    def update_cells(self, cell_list, value_input_option='RAW'):
+        for cell in cell_list:
+            if cell.value is None:
+                # null values are skipped, as in the Sheets API
+                continue
+            while len(self._rows) < cell.row:
+                self._rows.append([])
+            row = self._rows[cell.row - 1]
+            row.extend([''] * (cell.col - len(row)))
+            row[cell.col - 1] = self._to_str(cell.value)
+        self._save()
+
+    def insert_row(self, values, index=1, value_input_option='RAW'):
+        self._rows.insert(index - 1, [self._to_str(v) for v in values])
+        self._save()
+
+    def delete_row(self, index):
+        del self._rows[index - 1]
+        self._save()
+
+    def append_row(self, values, value_input_option='RAW'):
+        self._rows = self._values()
+        self._rows.append([self._to_str(v) for v in values])
+        self._save()
+
+
+def save_local_sheet(sheet, path):
+    """
+    Save a copy of sheet content to CSV, for use with LocalWorksheet
+
+    Arguments:
+        sheet: gspread sheet, connected
+        path: path to output CSV file
+    """
+    with open(os.path.expanduser(path), 'w', newline='') as fp:
+        csv.writer(fp).writerows(sheet.get_all_values())
+
+
+def get_client(key_file, local_sheet=None):
     """
     Return interfaces to Google Sheets data store
     
     Arguments:
         key_file: Google Sheets / Drive API secret key file
+        local_sheet: path to CSV file, if set, use a LocalWorksheet backed by
+            this file instead of Google Sheets, and ignore key_file
     
     Returns:
-        client: gspread.client.Client
-        doc: gspread.models.Spreadsheet
-        sheet: gspread.models.Worksheet
+        client: gspread.client.Client, None for local sheet
+        doc: gspread.models.Spreadsheet, None for local sheet
+        sheet: gspread.models.Worksheet, or LocalWorksheet
     """
+    if local_sheet:
+        return None, None, LocalWorksheet(local_sheet)
     key_file = os.path.expanduser(key_file)
     scope = ['https://spreadsheets.google.com/feeds',
              'https://www.googleapis.com/auth/drive']
@@ -46,6 +221,20 @@ def get_client(key_file):
     return client, doc, sheet
 
 
+def _values_to_frame(values, default_blank=nan):
+    """Convert sheet values (header row first) to dataframe, as get_all_records"""
+    records = [dict(zip(values[0], numericise_all(row, False, default_blank)))
+               for row in values[1:]]
+    return pd.DataFrame(records, columns=values[0])
+
+
+def _set_datetime_index(content):
+    """Set index of sheet content to datetime, parsed from DATE and TIME"""
+    dt_text = content['DATE'] + ' ' + content['TIME']
+    content.set_index(parse_datetimes(dt_text), inplace=True)
+    return content
+
+
 def read_sheet(sheet):
     """
     Read current data from Google Sheets and do some post-processing
@@ -60,9 +249,513 @@ def read_sheet(sheet):
     content = pd.DataFrame(content)
 
     # set index to datetime
-    dt_text = content['DATE'] + ' ' + content['TIME']
-    dt_idx = pd.DatetimeIndex(dt_text.apply(lambda x: dateutil.parser.parse(x)))
-    dt_idx = dt_idx.tz_localize(US_EASTERN)
-    content.set_index(dt_idx, inplace=True)
-    return content
+    return _set_datetime_index(content)
+
+
+def get_table_data(data, limit=None, columns=None):
+    """
+    Generate rows of sheet data for display, most recent day first
+
+    Only the requested window and columns are converted, so the cost scales
+    with the size of the table, not the sheet.
+
+    Arguments:
+        data: pandas dataframe, as returned by read_sheet()
+        limit: int, max number of rows, set None to include all
+        columns: list of column names to include, set None to include all
+
+    Returns: generator of dicts, each containing data for a single day, with
+        missing values as None
+    """
+    logger.info('Generating summary table')
+
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index(kind='mergesort')
+    window = data.iloc[::-1] if limit is None else data.iloc[:-limit-1:-1]
+    if columns is not None:
+        window = window[columns]
+
+    values = window.astype(object).values
+    values[window.isnull().values] = None
+    names = list(window.columns)
+    for row in values:
+        yield dict(zip(names, row))
+
+
+def _trim_values(values):
+    """Drop trailing empty rows, and pad rows to equal length"""
+    values = [list(row) for row in values]
+    while values and not any(values[-1]):
+        values.pop()
+    width = max([len(row) for row in values] or [0])
+    return [row + [''] * (width - len(row)) for row in values]
+
+
+def _read_sheet_tail(sheet, snapshot, mark, overlap):
+    """
+    Return sheet values, re-reading only the tail after a local snapshot
+
+    Arguments:
+        sheet: gspread sheet, connected
+        snapshot: list of rows (header first), as last read from sheet
+        mark: dict, high-water mark saved with the snapshot, with keys
+            num_rows and last_date
+        overlap: int, number of rows before the end of snapshot to re-read
+
+    Returns: list of rows (header first), or None if the snapshot no longer
+        lines up with the sheet and a full read is needed
+    """
+    # snapshot must be the one the mark was recorded for
+    date_col = snapshot[0].index('DATE')
+    num_rows = mark.get('num_rows')
+    if num_rows != len(snapshot) or num_rows < 2:
+        return None
+    if mark.get('last_date') != snapshot[num_rows - 1][date_col]:
+        return None
+
+    first_row = max(2, num_rows - overlap + 1) # 1-based, with header
+    if first_row > sheet.row_count:
+        return None
+    cells = sheet.range(first_row, 1, sheet.row_count, len(snapshot[0]))
+    tail = [[] for _ in range(sheet.row_count - first_row + 1)]
+    for cell in cells:
+        tail[cell.row - first_row].append(cell.value)
+    tail = _trim_values(tail)
+
+    # every re-read overlap row must have the same date, else rows moved
+    old = snapshot[first_row - 1:]
+    if len(tail) < len(old):
+        return None
+    if any(new[date_col] != prev[date_col] for new, prev in zip(tail, old)):
+        return None
+    num_edited = sum(new != prev for new, prev in zip(tail, old))
+    if num_edited:
+        logger.info('Updated {} edited rows in sheet snapshot'.format(num_edited))
+    return snapshot[:first_row - 1] + tail
+
+
+def read_sheet_incremental(sheet, path=None, overlap=SHEET_SNAPSHOT_OVERLAP,
+                           full=False):
+    """
+    Read current data, fetching only rows added or changed since last read
+
+    A local copy of the sheet values is kept at 'path', with a high-water mark
+    (row count and last DATE) in a sidecar file. Rows after the high-water
+    mark, plus 'overlap' rows before it, are read from the sheet and merged
+    into the local copy, row by row. Edits to rows older than the overlap
+    window are only picked up by a full read, which is done on the first run,
+    if any overlap row changed DATE (the sheet has been re-ordered), if the
+    mark does not match the snapshot, or if 'full' is set.
+
+    Arguments:
+        sheet: gspread sheet, connected
+        path: path to local snapshot CSV file, default is named for the
+            sheet title in SHEET_SNAPSHOT_DIR
+        overlap: int, number of rows before the end of the snapshot to re-read
+        full: bool, set True to force a full read
+
+    Return: pd dataframe containing current data, as read_sheet()
+    """
+    if path is None:
+        path = os.path.join(SHEET_SNAPSHOT_DIR, 'sheet-{}.csv'.format(sheet.title))
+
+    meta_path = path + SHEET_SNAPSHOT_META_EXT
+    values = None
+    if not full and os.path.isfile(path):
+        with open(path, 'r', newline='') as fp:
+            snapshot = [list(row) for row in csv.reader(fp)]
+        try:
+            with open(meta_path, 'r') as fp:
+                mark = json.load(fp)
+        except (IOError, ValueError):
+            mark = {}
+        if snapshot:
+            values = _read_sheet_tail(sheet, snapshot, mark, overlap)
+        if values is None:
+            logger.warning('Sheet snapshot is out of date, doing a full read')
+
+    if values is None:
+        values = _trim_values(sheet.get_all_values())
+        logger.info('Read {} rows from sheet'.format(len(values) - 1))
+    else:
+        logger.info('Read sheet incrementally, {} rows'.format(len(values) - 1))
+
+    # save snapshot and high-water mark
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w', newline='') as fp:
+        csv.writer(fp).writerows(values)
+    os.replace(path + '.tmp', path)
+    with open(meta_path, 'w') as fp:
+        json.dump({'num_rows': len(values),
+                   'last_date': values[-1][values[0].index('DATE')]}, fp)
+
+    return _set_datetime_index(_values_to_frame(values))
+
+
+def _http_cache_key(url):
+    """Return readable cache file name for 'url'"""
+    return re.sub(r'[^A-Za-z0-9.\-]+', '_', re.sub(r'^\w+://', '', url))
+
+
+def _http_cache_evict(cache_dir, max_bytes, keep):
+    """Delete least-recently-used cache entries until under 'max_bytes'"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(HTTP_CACHE_META_EXT) or not os.path.isfile(path):
+            continue
+        entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        if os.path.isfile(path + HTTP_CACHE_META_EXT):
+            os.remove(path + HTTP_CACHE_META_EXT)
+        total -= size
+
+
+def http_get_cached(url, cache_dir, ttl_sec, max_bytes=None, offline=False):
+    """
+    Return text content at 'url', using an on-disk cache
+
+    Each response body is stored in cache_dir under a file name derived from
+    the URL (e.g. www.ndbc.noaa.gov_data_realtime2_44020.txt), alongside a
+    metadata file with the fetch time and validators. Fresh entries are
+    returned without a request, stale entries are revalidated with a
+    conditional GET (ETag / Last-Modified). If the request fails, a stale
+    cached copy is returned when available. Body files may be pre-seeded to
+    run offline, their fetch time is taken from the file modification time.
+
+    Arguments:
+        url: string, URL to retrieve
+        cache_dir: path to cache directory, created if needed
+        ttl_sec: int or None, max age of cached content before revalidating,
+            set None to never expire
+        max_bytes: int or None, max total size of cached bodies, least
+            recently used entries are evicted beyond this
+        offline: bool, set True to use cached content only, never the network
+
+    Returns: string, response body
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    body_path = os.path.join(cache_dir, _http_cache_key(url))
+    meta_path = body_path + HTTP_CACHE_META_EXT
+
+    # read cached content, if any
+    body = meta = None
+    if os.path.isfile(body_path):
+        with open(body_path, 'r') as fp:
+            body = fp.read()
+        try:
+            with open(meta_path, 'r') as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            meta = {}
+
+    # record fetch time of pre-seeded entries before the mtime is touched
+    if body is not None and 'fetched' not in meta:
+        meta['fetched'] = os.path.getmtime(body_path)
+        with open(meta_path, 'w') as fp:
+            json.dump(meta, fp)
+
+    # return fresh cached content, touch body to mark it recently used
+    now = time.time()
+    if body is not None:
+        age = now - meta['fetched']
+        if offline or ttl_sec is None or age < ttl_sec:
+            os.utime(body_path, None)
+            return body
+    if offline:
+        raise IOError('No cached copy of {} in {}'.format(url, cache_dir))
+
+    # revalidate or fetch
+    headers = {}
+    if body is not None and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if body is not None and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        resp = requests.get(url, headers=headers)
+        if resp.status_code != 304 or body is None:
+            resp.raise_for_status()
+    except requests.RequestException as err:
+        if body is None:
+            raise
+        logger.warning('Failed to fetch {}, using stale cached copy: {}'.format(url, err))
+        return body
+    if resp.status_code == 304 and body is not None:
+        meta['fetched'] = now
+    else:
+        body = resp.text
+        meta = {
+            'url': url,
+            'fetched': now,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            }
+        with open(body_path + '.tmp', 'w') as fp:
+            fp.write(body)
+        os.replace(body_path + '.tmp', body_path)
+    with open(meta_path, 'w') as fp:
+        json.dump(meta, fp)
+
+    if max_bytes is not None:
+        _http_cache_evict(cache_dir, max_bytes, keep=body_path)
+
+    return body
+
+
+def content_digest(content):
+    """Return SHA-1 hex digest of 'content', bytes or string (utf-8)"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def file_digest(path):
+    """Return SHA-1 hex digest of file at 'path', or None if it is missing"""
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as fp:
+        return content_digest(fp.read())
+
+
+def frame_digest(data):
+    """Return SHA-1 hex digest of a pandas Dataframe, including its index"""
+    sha = hashlib.sha1(','.join(map(str, data.columns)).encode('utf-8'))
+    sha.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    return sha.hexdigest()
+
+
+def write_if_changed(path, content):
+    """
+    Write 'content' to 'path' atomically, unless the file already holds it
+
+    Arguments:
+        path: path to output file, parent directory must exist
+        content: bytes or string (written as utf-8)
+
+    Returns: bool, True if the file was written
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if os.path.isfile(path) and os.path.getsize(path) == len(content):
+        with open(path, 'rb') as fp:
+            if fp.read() == content:
+                return False
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(content)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+_HTML_PRESERVE = re.compile(r'(<(script|style|pre|textarea)\b.*?</\2>)', re.S | re.I)
+
+
+def minify_html(text):
+    """
+    Return HTML text with indentation and blank lines removed
+
+    Whitespace runs containing a newline are collapsed to a single newline,
+    which renders the same. Script, style, pre and textarea elements are left
+    unchanged.
+    """
+    parts = _HTML_PRESERVE.split(text)
+    out = []
+    for ii in range(0, len(parts), 3):
+        out.append(re.sub(r'\s*\n\s*', '\n', parts[ii]))
+        if ii + 1 < len(parts):
+            out.append(parts[ii + 1])
+    return ''.join(out).strip() + '\n'
+
+
+def _gzip_bytes(content):
+    """Return gzip-compressed 'content', with a fixed header timestamp"""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as fp:
+        fp.write(content)
+    return buf.getvalue()
+
+
+def write_precompressed(path, content):
+    """
+    Write file and precompressed .gz (and .br, if brotli is installed)
+    siblings, each only if changed, see write_if_changed()
+
+    Returns: bool, True if the uncompressed file was written
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    written = write_if_changed(path, content)
+    if written or not os.path.isfile(path + '.gz'):
+        write_if_changed(path + '.gz', _gzip_bytes(content))
+    if brotli is not None and (written or not os.path.isfile(path + '.br')):
+        write_if_changed(path + '.br', brotli.compress(content))
+    return written
+
+
+def remove_precompressed(path):
+    """Delete precompressed siblings of 'path', see write_precompressed()"""
+    for ext in PRECOMPRESSED_EXTS:
+        if os.path.isfile(path + ext):
+            logger.info('Removing stale {}'.format(path + ext))
+            os.remove(path + ext)
+
+
+def get_template_env(templates_dir, cache_dir=TEMPLATE_CACHE_DIR):
+    """
+    Return Jinja2 environment for templates in 'templates_dir'
+
+    The environment is created once per process. Compiled templates are
+    cached in 'cache_dir' across runs, and output is autoescaped for HTML
+    templates (use the 'safe' filter for markup).
+
+    Arguments:
+        templates_dir: path to directory containing templates
+        cache_dir: path to bytecode cache directory, or None to disable
+    """
+    key = (templates_dir, cache_dir)
+    if key not in _template_envs:
+        bytecode_cache = None
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        _template_envs[key] = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(templates_dir),
+            bytecode_cache=bytecode_cache,
+            autoescape=jinja2.select_autoescape(['html']),
+            keep_trailing_newline=True,
+            )
+    return _template_envs[key]
+
+
+def render_templates(env, outputs, **context):
+    """
+    Render templates to files, streamed, writing only files that change
+
+    Each template is streamed to a temporary file, which replaces the output
+    file atomically only if the contents differ.
+
+    Arguments:
+        env: Jinja2 environment, see get_template_env()
+        outputs: dict, output file path keyed by template name
+        context: template variables, shared by all templates
+
+    Returns: dict, True if the file was written, keyed by template name
+    """
+    written = {}
+    for name, path in outputs.items():
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            env.get_template(name).stream(**context).dump(fp)
+        if os.path.isfile(path) and filecmp.cmp(tmp, path, shallow=False):
+            os.remove(tmp)
+            written[name] = False
+        else:
+            os.replace(tmp, path)
+            written[name] = True
+    return written
+
+
+def _run_timed(func, *args):
+    """Return result of func(*args) and its wall time, in seconds"""
+    tic = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - tic
+
+
+def _dependents(stages, names):
+    """Return set of stage names and all stages that depend on them"""
+    found = set(names)
+    while True:
+        more = {k for k, v in stages.items() if found.intersection(v.deps)} - found
+        if not more:
+            return found
+        found |= more
+
+
+def run_stages(stages, cache_dir=None, only=None, max_workers=None, key=None):
+    """
+    Run build stages concurrently, each as soon as its dependencies are done
+
+    Thread stages share a thread pool, process stages share a process pool,
+    so functions and results of process stages must be picklable. If a cache
+    directory is given, each result is pickled there with 'key', and a subset
+    of stages can be rebuilt using the cached results of the others. Cached
+    results saved with a different key are not used, so pass a digest of the
+    stage inputs (e.g. frame_digest()) to rebuild all stages when they change.
+
+    Arguments:
+        stages: dict of Stage, keyed by name
+        cache_dir: path to directory for cached results, or None
+        only: list of stage names to run, along with all stages that depend
+            on them, or None to run all, requires cache_dir
+        max_workers: int or None, max concurrent stages of each executor type
+        key: string, digest of the inputs shared by all stages, or None
+
+    Returns: dict of stage results, keyed by name
+    """
+    for name, stage in stages.items():
+        missing = set(stage.deps) - set(stages)
+        if missing:
+            raise ValueError('Stage {} depends on unknown stages {}'.format(name, missing))
+    if only is not None and set(only) - set(stages):
+        raise ValueError('Unknown stages {}'.format(set(only) - set(stages)))
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    def cache_path(name):
+        return os.path.join(cache_dir, name + '.pkl')
+    def cached_key(name):
+        try:
+            with open(cache_path(name) + STAGE_CACHE_KEY_EXT, 'r') as fp:
+                return fp.read()
+        except IOError:
+            return None
+
+    # load cached results for stages that are not rebuilt, and current
+    results = {}
+    todo = set(stages) if only is None else _dependents(stages, only)
+    for name in set(stages) - todo:
+        if (not cache_dir or not os.path.isfile(cache_path(name))
+                or cached_key(name) != str(key)):
+            todo |= _dependents(stages, [name])
+            continue
+        with open(cache_path(name), 'rb') as fp:
+            results[name] = pickle.load(fp)
+        logger.info('Stage {}: using cached result'.format(name))
+
+    tic = time.perf_counter()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as threads, \
+            ProcessPoolExecutor(max_workers=max_workers) as processes:
+        pools = {'thread': threads, 'process': processes}
+        while todo or running:
+            ready = [k for k in todo if all(d in results for d in stages[k].deps)]
+            for name in sorted(ready):
+                stage = stages[name]
+                args = [results[d] for d in stage.deps]
+                future = pools[stage.executor].submit(_run_timed, stage.func, *args)
+                running[future] = name
+                todo.remove(name)
+            if not running:
+                raise ValueError('Dependency cycle among stages {}'.format(todo))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], elapsed = future.result()
+                logger.info('Stage {}: {:.2f} s'.format(name, elapsed))
+                if cache_dir:
+                    with open(cache_path(name) + '.tmp', 'wb') as fp:
+                        pickle.dump(results[name], fp)
+                    os.replace(cache_path(name) + '.tmp', cache_path(name))
+                    with open(cache_path(name) + STAGE_CACHE_KEY_EXT, 'w') as fp:
+                        fp.write(str(key))
+    logger.info('All stages complete in {:.2f} s'.format(time.perf_counter() - tic))
 
+    return results
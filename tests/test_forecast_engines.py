@@ -0,0 +1,62 @@
+"""
+Resuming recursive forecast engines from cached state matches a full replay
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mvpb_forecast import retrospective, ahead, MODEL_EXOG, ENGINES
+
+
+def _synthetic_sheet(num, seed=0):
+    """Return sheet-like dataframe with attendance driven by day and weather"""
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2016-01-01 07:30', periods=num, freq='D', tz='US/Eastern')
+    dow = np.asarray(index.dayofweek)
+    data = pd.DataFrame({name: rng.rand(num) * 10 for name in MODEL_EXOG}, index=index)
+    data['GROUP'] = np.round(20 + 8 * (dow >= 5) + data[MODEL_EXOG[0]] + rng.randn(num) * 4)
+    return data
+
+
+@pytest.mark.parametrize('engine', sorted(ENGINES))
+@pytest.mark.parametrize('horizon', [1, 3])
+def test_resume_after_last_row_edited(tmpdir, engine, horizon):
+    # the day's row is created blank, then filled in with a new row appended
+    cache = str(tmpdir.join('retrospective.npz'))
+    data = _synthetic_sheet(301)
+    blank = data.iloc[:300].copy()
+    blank.iloc[-1, blank.columns.get_loc('GROUP')] = np.nan
+    blank.iloc[-1, blank.columns.get_loc(MODEL_EXOG[0])] = np.nan
+    retrospective(blank, first=200, cache=cache, engine=engine, horizon=horizon)
+
+    resumed = retrospective(data, first=200, cache=cache, engine=engine, horizon=horizon)
+    replayed = retrospective(data, first=200, engine=engine, horizon=horizon)
+    for got, want in zip(resumed, replayed):
+        np.testing.assert_array_equal(got, want)
+
+
+@pytest.mark.parametrize('engine', sorted(ENGINES))
+def test_resume_after_append(tmpdir, engine):
+    cache = str(tmpdir.join('retrospective.npz'))
+    data = _synthetic_sheet(301)
+    retrospective(data.iloc[:300], first=200, cache=cache, engine=engine)
+
+    resumed = retrospective(data, first=200, cache=cache, engine=engine)
+    replayed = retrospective(data, first=200, engine=engine)
+    for got, want in zip(resumed, replayed):
+        np.testing.assert_array_equal(got, want)
+
+
+@pytest.mark.parametrize('engine', sorted(ENGINES))
+def test_ahead_resume_after_recent_rows_edited(tmpdir, engine):
+    cache = str(tmpdir.join('tomorrow.json'))
+    data = _synthetic_sheet(303)
+    ahead(data.iloc[:300], cache=cache, engine=engine)
+
+    edited = data.copy()
+    edited.iloc[-4, edited.columns.get_loc('GROUP')] += 5
+    for sheet in [data.iloc[:301], data, edited]:
+        resumed = ahead(sheet, cache=cache, engine=engine)
+        replayed = ahead(sheet, engine=engine)
+        pd.testing.assert_frame_equal(resumed, replayed)
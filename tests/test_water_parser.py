@@ -0,0 +1,57 @@
+"""
+Parity of the vectorized NDBC parser with the original regex/replace parser
+"""
+
+import io
+import os
+import re
+import glob
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+from mvpb_data import _water_to_dataframe, NDBC_MISSING, UTC
+
+
+DATA_FILES = sorted(glob.glob(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', '*.txt')))
+
+
+def _legacy_water_to_dataframe(txt):
+    """Original parser, before vectorization"""
+    stream = io.StringIO(re.sub(r' +', ' ', txt).replace('#', ''))
+    data = pd.read_csv(stream, sep=' ', skiprows=[1])
+    data.replace('MM', np.nan)
+    return data
+
+
+def _legacy_water_to_datetime(row):
+    """Original per-row timestamp conversion"""
+    return datetime(
+        year=round(row['YY']), month=round(row['MM']), day=round(row['DD']),
+        hour=round(row['hh']), minute=round(row['mm']), tzinfo=UTC)
+
+
+@pytest.mark.parametrize('path', DATA_FILES, ids=os.path.basename)
+def test_parser_matches_legacy(path):
+    with open(path, 'r') as fp:
+        txt = fp.read()
+    new = _water_to_dataframe(txt)
+    old = _legacy_water_to_dataframe(txt)
+
+    # same fields and rows
+    assert list(new.columns[:-1]) == list(old.columns)
+    assert len(new) == len(old)
+
+    # same values, once the legacy output has its sentinels masked
+    for name in old.columns:
+        expected = pd.to_numeric(old[name].replace('MM', np.nan), errors='coerce')
+        if name in NDBC_MISSING:
+            expected = expected.mask(expected == NDBC_MISSING[name])
+        np.testing.assert_array_equal(new[name].values.astype(float),
+                                      expected.values.astype(float), err_msg=name)
+
+    # same timestamps
+    expected = old.apply(_legacy_water_to_datetime, axis=1)
+    assert (new['DATETIME'] == pd.to_datetime(expected.values, utc=True)).all()